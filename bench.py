@@ -0,0 +1,345 @@
+############################################
+## benchmarks for ingest, tally and output of the elo and harkness runners, on synthetic data
+## a results/<gender>/<year>/<date>_<codex>.tsv tree is generated in a scratch directory, then each scenario is
+## timed in its own forked process so its peak memory can be read back from /proc (linux only)
+## the parse scenarios time scraper.py's html parsing on synthetic event and race pages in the FIS layout, and the
+## cache scenarios time refreshing an unchanged compiled race cache (see results_io.py) and reading races from it
+## usage: python bench.py [--skiers N] [--dates N] [--field-min N] [--field-max N] [--field-mode N] ...
+#############################################
+
+import os
+import sys
+import time
+import random
+import shutil
+import Queue
+import argparse
+import datetime
+import tempfile
+import traceback
+import multiprocessing
+
+import elo_run
+import harkness_run
+
+from results_io import find_all_results, read_race_files, compile_race_cache, RaceCache, RACE_CACHE_PATH
+
+GENDER = "M"
+
+def generate_results(root, n_skiers, n_dates, field_min, field_max, field_mode = None, races_per_date = 1, seed = 0):
+	"""
+		write a synthetic results tree under <root>, in the layout scraper.py produces
+		field sizes are drawn uniformly from [field_min, field_max], or from a triangular distribution if field_mode is given
+		returns the number of races written
+	"""
+	rand = random.Random(seed)
+
+	skiers = ["%07d"%(x) for x in rand.sample(xrange(1000000,10000000), n_skiers)]
+	day = datetime.date(2001,1,1)
+	n_races = 0
+
+	for i in xrange(0,n_dates):
+		day += datetime.timedelta(days = rand.randint(1,3))
+		year_path = "%s/results/%s/%d"%(root, GENDER, day.year)
+		if not os.path.exists(year_path):
+			os.makedirs(year_path)
+
+		for j in xrange(0,races_per_date):
+			if field_mode == None:
+				field_size = rand.randint(field_min, field_max)
+			else:
+				field_size = int(round(rand.triangular(field_min, field_max, field_mode)))
+			field = rand.sample(skiers, min(field_size, n_skiers))
+
+			file = open("%s/%s_%d.tsv"%(year_path, day.strftime("%Y.%m.%d"), 1000 + n_races),'w')
+			for place, skier_id in enumerate(field):
+				file.write("%s\tSkier %s\t%d\t%d:%02d.%d\n"%(skier_id, skier_id, place + 1, 25 + place/60, place%60, place%10))
+			file.write("NA\tNA\tDNF\tNA\n") ##a row filter_valid_results rejects, as in real scrapes
+			file.close()
+			n_races += 1
+
+	return n_races
+
+## page furniture around the tables the scraper reads- menus, scripts (one building a table) and a footer
+PAGE_HEAD = "<html><head><script>var t = '<table class=\"popup\">';</script><style>table td {padding: 0}</style></head><body>\n%s\n"%(
+	"\n".join(['<div class="menu"><a href="/menu/%d.html">Menu entry %d</a></div>'%(x,x) for x in xrange(0,400)]))
+PAGE_FOOT = "\n<!-- <table> -->%s</body></html>"%(
+	"\n".join(['<table class="footer"><tr><td><a href="/footer/%d.html">Footer %d</a></td></tr></table>'%(x,x) for x in xrange(0,20)]))
+
+def generate_event_page(rand, n_races):
+	"""
+		an event page- the races table (with a nested table in one cell) followed by another table of links
+	"""
+	rows = []
+	for i in xrange(0,n_races):
+		rows.append('<tr><td><a href="/x">%d</a></td><td><a>%02d.%02d.%d</a></td><td><a>FIN</a></td><td><a href="/results.html?race=%d">Results</a></td>'
+			'<td><a>%d</a></td><td><a>%s</a></td><td><a>%s</a></td><td><table><tr><td>nested</td></tr></table></td></tr>'%(i, rand.randint(1,28), rand.randint(1,12),
+			rand.randint(2000,2017), rand.randint(1,99999), 1000 + i, rand.choice(["15 km C", "Sprint F", "Sprint Qual", "4x10 km Rel"]), rand.choice(["M","L"])))
+	table = '<table><thead><tr><th>Date</th></tr></thead><tbody>%s</tbody></table><table><tbody><tr><td><a>Other</a></td><td><a>01.01.2000</a></td></tr></tbody></table>'%("\n".join(rows))
+	return PAGE_HEAD + table + PAGE_FOOT
+
+def generate_race_page(rand, field_size):
+	"""
+		a race page- a header table, the results table (names with escaped characters) and a trailing table
+	"""
+	rows = ['<tr><th>Rank</th><th>Bib</th><th>FIS Code</th><th>Athlete</th></tr>']
+	for i in xrange(0,field_size):
+		rows.append('<tr><td>%d</td><td>%d</td><td>%07d</td><td><a href="/athlete/%d">Sk&iacute;er %d</a></td><td>1990</td><td>NOR</td><td>%d:%02d.%d</td></tr>'%(
+			i + 1, i + 10, rand.randint(1000000,9999999), i, i, 25 + i/60, i%60, i%10))
+	rows.append('<tr><td>DNF</td><td>7</td><td>1000999</td><td><a>Quit Er</a></td><td></td><td></td><td></td></tr>')
+	table = '<table><tr><td>Race details</td></tr></table><table>%s</table><table><tr><td>1</td><td>2</td><td>3</td></tr></table>'%("\n".join(rows))
+	return PAGE_HEAD + table + PAGE_FOOT
+
+def generate_pages(n_pages, field_min, field_max, seed = 0):
+	"""
+		(event pages, race pages) in the layout scraper.py parses
+	"""
+	rand = random.Random(seed)
+	events = [generate_event_page(rand, rand.randint(1,8)) for x in xrange(0,n_pages)]
+	races = [generate_race_page(rand, rand.randint(field_min, field_max)) for x in xrange(0,n_pages)]
+	return events, races
+
+def read_memory():
+	"""
+		(current, peak) resident memory of this process in kB, from /proc/self/status
+	"""
+	memory = {}
+	for line in open("/proc/self/status"):
+		if line.startswith("VmRSS:") or line.startswith("VmHWM:"):
+			fields = line.split()
+			memory[fields[0]] = int(fields[1])
+	return memory.get("VmRSS:",0), memory.get("VmHWM:",0)
+
+def reset_peak_memory():
+	"""
+		reset the peak resident memory counter, so it only covers what follows
+	"""
+	try:
+		file = open("/proc/self/clear_refs",'w')
+		file.write("5")
+		file.close()
+	except IOError:
+		pass ##older kernels- the peak will include setup
+
+def load(module):
+	filer = module.SupportFiler(GENDER)
+	for date, codex, results in read_race_files(find_all_results(GENDER)):
+		filer.add_race(results, date, codex)
+	return filer
+
+def make_runner(module, filer):
+	if module == elo_run:
+		return elo_run.EloRunner(filer.date_results, filer.name_lookup, filer.skiers)
+	return harkness_run.HarknessRunner(filer.date_results, filer.name_lookup, filer.skiers)
+
+def tally(runner, filer):
+	for date in sorted(filer.date_results.keys()):
+		runner.tally_race(date, filer.date_results[date])
+
+def count_pairs(filer):
+	if isinstance(filer, elo_run.SupportFiler):
+		return sum([len(x)*(len(x)-1)/2 for rankings in filer.date_results.values() for x in rankings])
+	return sum([len(x)*(len(x)-1)/2 for x in filer.date_results.values()])
+
+## each scenario is (name, setup, timed, unit, count)- setup(module) returns state for the untimed part,
+## timed(state) is the measured work, and count(state) is the number of <unit>s it handled
+def setup_none(module):
+	return None
+
+def timed_read(state):
+	return list(read_race_files(find_all_results(GENDER)))
+
+def setup_cache(module):
+	compile_race_cache(GENDER)
+	return None
+
+def timed_cache_refresh(state):
+	##nothing has changed since setup, so this should only cost the file listing
+	compile_race_cache(GENDER)
+	return RaceCache(RACE_CACHE_PATH%(GENDER))
+
+def timed_cache_read(state):
+	return list(RaceCache(RACE_CACHE_PATH%(GENDER)).races())
+
+def setup_races(module):
+	return (module, list(read_race_files(find_all_results(GENDER))))
+
+def timed_ingest(state):
+	module, races = state
+	filer = module.SupportFiler(GENDER)
+	for date, codex, results in races:
+		filer.add_race(results, date, codex)
+	return filer
+
+def setup_runner(module):
+	filer = load(module)
+	return (make_runner(module, filer), filer)
+
+def timed_tally(state):
+	runner, filer = state
+	tally(runner, filer)
+	return state
+
+def setup_tallied(module):
+	runner, filer = setup_runner(module)
+	tally(runner, filer)
+	return (runner, filer)
+
+def timed_write(state):
+	runner, filer = state
+	path = os.path.join(os.getcwd(), "bench_out")
+	if isinstance(runner, elo_run.EloRunner):
+		runner.write_elo_to_file(path, "tsv")
+	else:
+		runner.write_hark_to_file(path, "tsv")
+	return state
+
+def setup_pages(module):
+	return generate_pages(PARSE_PAGES, 30, 100)
+
+def parse_pages(pages):
+	import scraper
+	events, races = pages
+	parsed_races = [scraper.parse_races(x, "bench") for x in events]
+	parsed_results = [scraper.parse_results(x) for x in races]
+	return parsed_races, parsed_results
+
+def setup_checked_pages(module):
+	"""
+		pages for the fast parse, after checking it gives the same races and results as the whole page parse
+	"""
+	import scraper
+	pages = setup_pages(module)
+
+	scraper.FAST_PARSE = False
+	expected = parse_pages(pages)
+	scraper.FAST_PARSE = True
+	parsed = parse_pages(pages)
+
+	fields = lambda races, results: ([[(x.url, x.date, x.codex, x.name, x.gender) for x in y] for y in races],
+		[[x.to_tab_string() for x in y] for y in results])
+	if fields(*expected) != fields(*parsed):
+		raise Exception("the fast parse disagrees with the whole page parse")
+	return pages
+
+def timed_parse(pages):
+	parse_pages(pages)
+	return pages
+
+PARSE_PAGES = 200 ## event pages and race pages each, for the parse scenarios
+
+SCENARIOS = [
+	("read", None, setup_none, timed_read, "rows", lambda state: sum([len(x[2]) for x in state])),
+	("cache_refresh", None, setup_cache, timed_cache_refresh, "races", lambda cache: len(cache.index)),
+	("cache_read", None, setup_cache, timed_cache_read, "rows", lambda state: sum([len(x[2]) for x in state])),
+	("ingest", elo_run, setup_races, timed_ingest, "races", lambda filer: sum([len(x) for x in filer.date_codex.values()])),
+	("ingest", harkness_run, setup_races, timed_ingest, "races", lambda filer: sum([len(x) for x in filer.date_codex.values()])),
+	("tally", elo_run, setup_runner, timed_tally, "pairs", lambda state: count_pairs(state[1])),
+	("tally_numpy", elo_run, setup_runner, timed_tally, "pairs", lambda state: count_pairs(state[1])),
+	("tally", harkness_run, setup_runner, timed_tally, "races", lambda state: len(state[1].date_results)),
+	("write", elo_run, setup_tallied, timed_write, "cells", lambda state: len(state[0].row_labels)*len(state[0].col_labels)),
+	("write", harkness_run, setup_tallied, timed_write, "cells", lambda state: len(state[0].row_labels)*len(state[0].col_labels)),
+	("parse", None, setup_pages, timed_parse, "pages", lambda pages: len(pages[0]) + len(pages[1])),
+	("parse_fast", None, setup_checked_pages, timed_parse, "pages", lambda pages: len(pages[0]) + len(pages[1])),
+]
+
+def run_scenario(scenario, queue):
+	"""
+		run a scenario in a forked process, reporting (seconds, cpu seconds, count, peak kB) back over the queue
+		or the traceback, if it fails
+	"""
+	name, module, setup, timed, unit, count = scenario
+	try:
+		if name == "tally_numpy":
+			elo_run.TALLY_MODE = "numpy"
+		if name.startswith("parse"):
+			import scraper
+			scraper.FAST_PARSE = name == "parse_fast"
+
+		state = setup(module)
+
+		reset_peak_memory()
+		rss_before = read_memory()[0]
+		start = time.time()
+		cpu_start = time.clock()
+
+		state = timed(state)
+
+		seconds = time.time() - start
+		cpu_seconds = time.clock() - cpu_start
+		peak = read_memory()[1] - rss_before
+
+		queue.put((seconds, cpu_seconds, count(state), peak))
+	except Exception:
+		queue.put(traceback.format_exc())
+
+def wait_for_scenario(p, queue):
+	"""
+		what a scenario's process reports, or a message if it dies without reporting (e.g. killed, or a crash in C)
+	"""
+	while True:
+		try:
+			return queue.get(timeout = 1)
+		except Queue.Empty:
+			if not p.is_alive():
+				##anything put just before exiting is already in the pipe
+				try:
+					return queue.get_nowait()
+				except Queue.Empty:
+					return "exited with code %s before reporting\n"%(p.exitcode)
+
+def main():
+	global PARSE_PAGES
+	parser = argparse.ArgumentParser(description = "time ingest, tally and output on a synthetic results tree")
+	parser.add_argument("--skiers", type = int, default = 2000, help = "number of distinct skiers")
+	parser.add_argument("--dates", type = int, default = 500, help = "number of race dates")
+	parser.add_argument("--races-per-date", type = int, default = 1, help = "races on each date")
+	parser.add_argument("--field-min", type = int, default = 30, help = "smallest field size")
+	parser.add_argument("--field-max", type = int, default = 100, help = "largest field size")
+	parser.add_argument("--field-mode", type = int, default = None, help = "most common field size (triangular distribution), uniform if unset")
+	parser.add_argument("--parse-pages", type = int, default = PARSE_PAGES, help = "event and race pages for the parse scenarios")
+	parser.add_argument("--seed", type = int, default = 0)
+	parser.add_argument("--only", default = None, help = "only run scenarios whose name contains this")
+	args = parser.parse_args()
+	PARSE_PAGES = args.parse_pages
+
+	root = tempfile.mkdtemp(prefix = "skilo_bench_")
+	cwd = os.getcwd()
+
+	try:
+		start = time.time()
+		n_races = generate_results(root, args.skiers, args.dates, args.field_min, args.field_max, args.field_mode, args.races_per_date, args.seed)
+		print "generated %d races over %d dates for %d skiers in %.1fs\n"%(n_races, args.dates, args.skiers, time.time() - start)
+
+		os.chdir(root)
+
+		print "%-14s %-10s %10s %10s %14s %12s %10s"%("scenario", "system", "seconds", "cpu", "count", "per second", "peak MB")
+		for scenario in SCENARIOS:
+			name, module = scenario[0], scenario[1]
+			system = module.__name__.replace("_run","") if module != None else "-"
+
+			if args.only != None and not args.only in name:
+				continue
+			if name == "tally_numpy" and elo_run.np == None:
+				continue
+
+			queue = multiprocessing.Queue()
+			p = multiprocessing.Process(target = run_scenario, args = (scenario, queue))
+			p.start()
+			result = wait_for_scenario(p, queue)
+			p.join()
+
+			if isinstance(result, str):
+				##keep going with the other scenarios
+				sys.stderr.write(result)
+				print "%-14s %-10s failed: %s"%(name, system, result.strip().split('\n')[-1])
+				continue
+			seconds, cpu_seconds, count, peak = result
+
+			print "%-14s %-10s %10.3f %10.3f %8d %-5s %12.0f %10.1f"%(name, system, seconds, cpu_seconds, count, scenario[4], count/max(seconds, 1e-9), peak/1024.0)
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(root)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,68 @@
+############################################
+## rating checkpoints, so elo_run.py/harkness_run.py can resume from the last processed date
+## instead of replaying the whole history
+## the checkpoint is a tsv: a last_date header line, then FIS CODE\tname\trace count\trating\tlast change date per skier
+#############################################
+
+import os
+
+class Checkpoint:
+	"""
+		a structure for the current state of a rating run
+	"""
+	def __init__(self, last_date = "0000.00.00"):
+		self.last_date = last_date
+		self.ratings = {} #fis_id,current rating pairs
+		self.race_count = {} #fis_id,number of races pairs
+		self.name_lookup = {} #fis_id,name pairs
+		self.last_change = {} #fis_id,date of the last rating change pairs- what a decay is measured from
+
+	def write(self, path):
+		"""
+			write the checkpoint to <path>, replacing any old checkpoint only once the new one is complete
+		"""
+		tmp_path = path + ".tmp"
+
+		file = open(tmp_path,'w')
+		file.write("last_date\t%s\n"%(self.last_date))
+
+		for skier_id in sorted(self.ratings.keys()):
+			##repr keeps full float precision, so a resumed run matches a full recompute
+			file.write("%s\t%s\t%d\t%r\t%s\n"%(skier_id, self.name_lookup.get(skier_id,"NA"), self.race_count.get(skier_id,0), self.ratings[skier_id],
+				self.last_change.get(skier_id,"NA")))
+
+		file.close()
+		os.rename(tmp_path, path)
+
+def resumed_path(path, last_date):
+	"""
+		where a run resumed from a checkpoint at <last_date> writes its output, so it doesn't clobber the full table
+		at <path> with one of only the newer dates- e.g. ./elo.tsv becomes ./elo_after_2015.03.01.tsv
+	"""
+	head, tail = os.path.split(path)
+	name, dot, ext = tail.partition(".")
+	return os.path.join(head, "%s_after_%s%s%s"%(name, last_date, dot, ext))
+
+def read_checkpoint(path):
+	"""
+		read a checkpoint written by Checkpoint.write
+	"""
+	file = open(path,'r')
+	lines = file.readlines()
+	file.close()
+
+	checkpoint = Checkpoint(lines[0].rstrip('\n').split('\t')[1])
+
+	for line in lines[1:]:
+		fields = line.rstrip('\n').split('\t')
+		skier_id = fields[0]
+
+		checkpoint.name_lookup[skier_id] = fields[1]
+		checkpoint.race_count[skier_id] = int(fields[2])
+		checkpoint.ratings[skier_id] = float(fields[3])
+
+		##checkpoints written before the last change dates were kept have no fifth field
+		if len(fields) > 4 and fields[4] != "NA":
+			checkpoint.last_change[skier_id] = fields[4]
+
+	return checkpoint
@@ -4,18 +4,49 @@
 
 import os
 import sys
+from array import array
+from itertools import izip
+
+from skier_table import SkierTable
+from rating_history import RatingHistory, day_numbers, exponential_decay
+from leaderboard import Leaderboard
+from checkpoint import Checkpoint, read_checkpoint, resumed_path
+from rating_writer import write_ratings
+from instrument import INSTRUMENTS
+from results_io import find_all_results, read_race_files, compile_race_cache, RaceCache, RaceColumns, RACE_CACHE_PATH
+from results_store import ResultsStore, RESULTS_DB_PATH
+
+try:
+	import numpy as np
+except ImportError:
+	np = None ##only needed for TALLY_MODE = "numpy"
 
 K=2
 DEFAULT_SCORE = 1000
 OUT_PATH = "./elo.tsv"
+OUT_FORMAT = "tsv" ## one of rating_writer.FORMATS- tsv, tsv.gz, npy, npz, long or index
 MIN_DATE = "2000.00.00"
 MIN_RACES = 10
+CHECKPOINT_PATH = "./elo_checkpoint.tsv"
+RESUME = False ## only ingest races dated after the checkpoint, starting from its scores- written to OUT_PATH tagged with the checkpoint date
+USE_RACE_CACHE = False ## load races from the compiled binary cache (refreshed for changed files) instead of the tsvs
+USE_RESULTS_DB = False ## load races from the sqlite store scraper.py writes with USE_RESULTS_DB, instead of the tsvs
+LOAD_PROCESSES = 1 ## >1 reads the race tsvs across a pool of processes
+REPORT_PATH = "./elo_report.json" ## json report of per phase timings and counters, written at the end of a run
+PROFILE_PATH = None ## set to a path to dump cProfile stats for the run
+TALLY_MODE = "loop" ## "loop" or "numpy" for the vectorized per-race update
+DECAY = None ## decay for idle skiers' scores, e.g. exponential_decay(365, DEFAULT_SCORE)- None for no decay
+LEADERBOARD_PATH = None ## set to a path to stream out the top LEADERBOARD_SIZE skiers (with MIN_RACES races so far) after each date
+LEADERBOARD_SIZE = 50
+LEADERBOARD_ONLY = False ## only write the leaderboard- no score history is kept, and no elo.tsv output written
 
 class SupportFiler:
 	def __init__(self,g):
 		self.gender = g
 		
-		self.date_results = {} # date, [(skier1,skier2),(skier1,skier3),.....] pairs
+		self.date_results = {} # date, [[skier1,skier2,...],[skier3,skier1,...],...] placement ordered race results, as arrays of skier ids
+		
+		self.skiers = SkierTable() # interned fis codes- the ids in date_results
 		
 		self.date_codex = {} # for looking up the event page- should be date,[codex1,codex2,] pairs
 		
@@ -23,26 +54,28 @@ class SupportFiler:
 	
 	def add_race(self, results, date, codex):
 		"""
-			given a 2d array of validated results, accumulate the elo-like win/lost relationships
-			(winner id, loser id)
+			given a 2d array of validated results (or a cached race's RaceColumns), record the placement ordered
+			skier ids for the race. winner/loser pairs are derived from the ranking when the race is tallied
 		"""
-		##first sort by order of placement - should already be sorted
-		results.sort(key = lambda x: int(x[2]))
+		if isinstance(results, RaceColumns):
+			##the cache stores races placement ordered
+			fis_codes = results.get_fis_codes()
+			names = results.get_names()
+		else:
+			##first sort by order of placement - should already be sorted
+			results.sort(key = lambda x: int(x[2]))
+			fis_codes = [x[0] for x in results]
+			names = [x[1] for x in results]
 
-		## now generate all winner/loser pairs
-		victory_pairs = []		
-		for i,entry in enumerate(results):
-			
-			if not entry[0] in self.name_lookup and not entry[1] == "NA":
-				self.name_lookup[entry[0]] = entry[1]
-			
-			for defeated in results[i+1:][:]:
-				victory_pairs.append((entry[0],defeated[0]))
+		for fis_code, name in izip(fis_codes, names):
+			if not fis_code in self.name_lookup and not name == "NA":
+				self.name_lookup[fis_code] = name
 		
 		##keep track of other metadata
 		if not date in self.date_results:
 			self.date_results[date] = []	
-		self.date_results[date] += victory_pairs
+		self.date_results[date].append(array('i', [self.skiers.intern(x) for x in fis_codes]))
+		INSTRUMENTS.count("races_filed")
 		
 		if not date in self.date_codex:
 			self.date_codex[date] = []
@@ -69,76 +102,139 @@ class SupportFiler:
 		
 		"""
 	
-def filter_valid_results(results):
+def victory_pairs(rankings):
 	"""
-		check if the file at <path> has the appropriate tsv structure, a fis id in the first field
-		and a ranking in the third field
+		generate all (winner id, loser id) pairs from a list of placement ordered race results
 	"""
-	
-	subset = []
-	
-	for entry in results:
-		##need 4 fields
-		if len(entry) == 4:
-			## need a valid fis id
-			if len(entry[0]) == 7 and entry[0].isdigit():
-				if len(entry[2]) > 0 and entry[2].isdigit():
-					subset.append(entry)
-	return subset
-	
+	for ranking in rankings:
+		for i,winner_id in enumerate(ranking):
+			for loser_id in ranking[i+1:]:
+				yield (winner_id, loser_id)
 
-def find_all_results(gender):
+def run_elo(filer, checkpoint = None):
 	"""
-		generate a list of all files across all years
+		given a filer object, perform an elo ranking
+		when resuming from a checkpoint, the filer should only hold races dated after it
 	"""
-	gender_path = "./results/%s/"%(gender)
-	year_dirs = [gender_path + x for x in os.listdir(gender_path)]
 	
-	##code barf- just rewrite if problem :)
-	race_tsvs = [y for x in [["%s/%s"%(year_dir,z) for z in os.listdir(year_dir)] for year_dir in year_dirs] for y in x]
+	if checkpoint != None:
+		for skier_id in checkpoint.name_lookup.keys():
+			if not skier_id in filer.name_lookup:
+				filer.name_lookup[skier_id] = checkpoint.name_lookup[skier_id]
 	
-	return race_tsvs
-
-def run_elo(filer):
-	"""
-		given a filer object, perform an elo ranking
-	"""
+	runner = EloRunner(filer.date_results, filer.name_lookup, filer.skiers, checkpoint)
 	
-	runner = EloRunner(filer.date_results, filer.name_lookup)
+	leaders = None
+	if LEADERBOARD_PATH != None:
+		leaders = open(LEADERBOARD_PATH,'w')
+		leaders.write("date\trank\tfis_id\tname\tscore\n")
 	
-	for date in sorted(filer.date_results.keys()):
-		print "handling %s results"%(date)
-		runner.tally_race(date,filer.date_results[date])
-		
-	runner.write_elo_to_file()
+	with INSTRUMENTS.phase("tally"):
+		for date in sorted(filer.date_results.keys()):
+			runner.tally_race(date,filer.date_results[date])
+			
+			if leaders != None:
+				runner.write_leaders(leaders, date)
+	
+	if leaders != None:
+		leaders.close()
+	
+	if not LEADERBOARD_ONLY:
+		with INSTRUMENTS.phase("write"):
+			##a resumed run only has the newer dates, so it goes beside the full table rather than over it
+			runner.write_elo_to_file(resumed_path(OUT_PATH, checkpoint.last_date) if checkpoint != None else None)
+	with INSTRUMENTS.phase("checkpoint"):
+		runner.get_checkpoint().write(CHECKPOINT_PATH)
 
 class EloRunner():
 	
-	def __init__(self, date_results, n_lookup):
+	def __init__(self, date_results, n_lookup, skiers, checkpoint = None):
 		self.name_lookup = n_lookup
 	
 		self.col_labels = sorted(date_results.keys())
 		self.row_labels = n_lookup.keys()
 		self.most_recent_date = "0000.00.00"
 		
-		##initialize all elo scores as -1, until a skier's first race
-		self.elo_scores = [[-1 for x in xrange(0,len(self.col_labels))] for y in xrange(0,len(self.row_labels))]
+		##interned integer ids for dates and skiers, so lookups don't scan the label lists
+		self.date_index = dict((d,i) for i,d in enumerate(self.col_labels))
+		self.skier_index = dict((s,i) for i,s in enumerate(self.row_labels))
+		self.skier_rows = [self.skier_index.get(x) for x in skiers.fis_codes] ##the filer's skier ids to rows
+		
+		##sparse score history- a score is only stored on the dates a skier races
+		##only a decay counts days, so only it needs every date label to be a real date- races with no date are filed under NA
+		days = day_numbers(self.col_labels) if DECAY != None else None
+		self.elo_history = RatingHistory(len(self.row_labels), len(self.col_labels), DEFAULT_SCORE, days, DECAY,
+			keep_history = not LEADERBOARD_ONLY)
 		self.race_count = {}
+		self.last_change = {} ##fis_id,date of each skier's last rating change, for the checkpoint
+		
+		##skiers with MIN_RACES races, ordered by current score as the races are tallied
+		if LEADERBOARD_PATH != None and DECAY != None:
+			raise ValueError("the leaderboard ranks undecayed scores, so can't be kept with DECAY")
+		self.leaderboard = Leaderboard() if LEADERBOARD_PATH != None else None
 		
-	def tally_race(self, date, pairs):
+		##resuming- skiers start from their checkpointed scores and race counts
+		if checkpoint != None:
+			self.most_recent_date = checkpoint.last_date
+			self.race_count.update(checkpoint.race_count)
+			self.last_change.update(checkpoint.last_change)
+			
+			##a decay runs from each skier's last change- an older checkpoint without those dates can't be resumed from
+			if DECAY != None and any([checkpoint.race_count.get(x,0) > 0 and not x in checkpoint.last_change for x in checkpoint.ratings]):
+				raise ValueError("the checkpoint has no last change dates to decay from- recompute from scratch to use DECAY")
+			
+			changed = sorted(set(checkpoint.last_change.values())) if DECAY != None else []
+			days = dict(zip(changed, day_numbers(changed)))
+			for skier_id in checkpoint.ratings.keys():
+				day = days.get(checkpoint.last_change.get(skier_id))
+				self.elo_history.seed(self.skier_index[skier_id], checkpoint.ratings[skier_id], day)
+			
+			if self.leaderboard != None:
+				self.update_leaderboard(checkpoint.ratings.keys())
+		
+	def tally_race(self, date, rankings):
 		if date < self.most_recent_date: ##string comp on yyyy.mm.dd
 			sys.stderr.write("Warning: you are delivering games out of time order.")
 		
 		self.most_recent_date = date
 		
+		INSTRUMENTS.count("races_tallied", len(rankings))
+		INSTRUMENTS.count("pairs_tallied", sum([len(x)*(len(x)-1)/2 for x in rankings]))
+		
+		date_ix = self.date_index[date]
+		rankings = [[self.skier_rows[x] for x in ranking] for ranking in rankings]
+		
+		if TALLY_MODE == "numpy":
+			score_sums = self.score_rankings_np(date_ix, rankings)
+		else:
+			score_sums = self.score_pairs(date_ix, victory_pairs(rankings))
+		
+		for skier_ix in score_sums.keys():
+			exp = self.elo_history.get(skier_ix, date_ix-1, date_ix)
+			self.elo_history.set(skier_ix, date_ix, exp + K*score_sums[skier_ix])
+			
+			##keep track of the number of races participated in
+			skier_id = self.row_labels[skier_ix]
+			if not skier_id in self.race_count:
+				self.race_count[skier_id] = 0
+			self.race_count[skier_id] += 1
+			self.last_change[skier_id] = date
+		
+		if self.leaderboard != None:
+			self.update_leaderboard([self.row_labels[x] for x in score_sums.keys()])
+		
+	def score_pairs(self, date_ix, pairs):
+		"""
+			accumulate the outcome - expectation sums for every skier over an iterable of (winner, loser) pairs of score history rows
+		"""
 		score_sums = {}
 		
 		for pair in pairs:
-			winner_id = pair[0]
-			loser_id = pair[1]
+			winner_ix = pair[0]
+			loser_ix = pair[1]
 			
-			we = self.get_elo(date, winner_id)
-			le = self.get_elo(date, loser_id)
+			we = self.elo_history.get(winner_ix, date_ix-1, date_ix)
+			le = self.elo_history.get(loser_ix, date_ix-1, date_ix)
 			
 			r_winner = 10**(we/400.0)
 			r_loser = 10**(le/400.0)
@@ -152,110 +248,142 @@ class EloRunner():
 			outcome_loser = -ex_loser
 			
 			## initialize dictionary entry if necessary
-			if not winner_id in score_sums:
-				score_sums[winner_id] = 0
-			if not loser_id in score_sums:
-				score_sums[loser_id] = 0
+			if not winner_ix in score_sums:
+				score_sums[winner_ix] = 0
+			if not loser_ix in score_sums:
+				score_sums[loser_ix] = 0
 			
-			score_sums[winner_id] += outcome_winner
-			score_sums[loser_id] += outcome_loser
+			score_sums[winner_ix] += outcome_winner
+			score_sums[loser_ix] += outcome_loser
+		
+		return score_sums
+	
+	def score_rankings_np(self, date_ix, rankings):
+		"""
+			vectorized score_pairs over the placement order of each race- each skier's strength 10**(elo/400)
+			is computed once, and a race's expectations come from one matrix over all its skiers
+		"""
+		score_sums = {}
+		
+		for ranking in rankings:
+			if len(ranking) == 0:
+				continue
 			
+			strength = 10**(np.array([self.elo_history.get(x, date_ix-1, date_ix) for x in ranking], dtype = float)/400.0)
 			
-		for skier_id in score_sums.keys():
-			exp = self.get_elo(date,skier_id)
-			self.add_elo(date, skier_id, exp + K*score_sums[skier_id])
+			##expected[i][j] is the expectation of skier i against skier j
+			expected = strength[:,None] / (strength[:,None] + strength[None,:])
 			
-			##keep track of the number of races participated in
-			if not skier_id in self.race_count:
-				self.race_count[skier_id] = 0
-			self.race_count[skier_id] += 1
-		
-		
-		## now fill in elo ratings for people who didn't compete in this race
-		self.update_elo(date)
+			##skiers win against everyone placed below them (upper triangle) and lose to everyone above
+			sums = np.triu(1 - expected, 1).sum(axis = 1) - np.tril(expected, -1).sum(axis = 1)
+			
+			for skier_ix, score in zip(ranking, sums.tolist()):
+				if not skier_ix in score_sums:
+					score_sums[skier_ix] = 0
+				score_sums[skier_ix] += score
 		
+		return score_sums
+	
 	def add_elo(self, date, skier_id, score):
-		date_ix = self.col_labels.index(date)
-		skier_ix = self.row_labels.index(skier_id)
+		date_ix = self.date_index[date]
+		skier_ix = self.skier_index[skier_id]
 		
-		self.elo_scores[skier_ix][date_ix] = score
+		self.elo_history.set(skier_ix, date_ix, score)
 		
 	def get_elo(self, max_date, skier_id):
 		"""
 			given a skier_id, get the up to date elo score
-			will return default=1000 if the player is yet to have an elo score recorded
+			will return default=1000 (or the checkpointed score) if the player is yet to have an elo score recorded
 		"""
 		
-		date_ix = self.col_labels.index(max_date)
-		skier_ix = self.row_labels.index(skier_id)
-		if date_ix > 0:
-			return self.elo_scores[skier_ix][date_ix-1]
-		else:
-			return DEFAULT_SCORE
+		date_ix = self.date_index[max_date]
+		skier_ix = self.skier_index[skier_id]
+		return self.elo_history.get(skier_ix, date_ix-1, date_ix)
 	
-	def update_elo(self, date):
+	def update_leaderboard(self, skier_ids):
 		"""
-			fill in elo for skiers that did not race in the last date
-			todo time decay- will also need to update the default_score scoring mechanism(puts later skiers at disadvantage) i.e. if has_skied(skier), then use decay
-			keep a structure for time from the last event
+			move skiers with at least MIN_RACES races to their current scores on the leaderboard
 		"""
-		date_ix = self.col_labels.index(date)
-		if date_ix > 0:
-			for i in range(0,len(self.elo_scores)):
-				if self.elo_scores[i][date_ix] < 0:
-					self.elo_scores[i][date_ix] = self.elo_scores[i][date_ix-1]
-		else:
-			for i in range(0,len(self.elo_scores)):
-				if self.elo_scores[i][date_ix] < 0:
-					self.elo_scores[i][date_ix] = DEFAULT_SCORE
-
-	def write_elo_to_file(self):
+		for skier_id in skier_ids:
+			if self.race_count.get(skier_id,0) >= MIN_RACES:
+				skier_ix = self.skier_index[skier_id]
+				self.leaderboard.update(skier_ix, self.elo_history.current[skier_ix])
 	
-		##write the elo scores, with row/column headers		
-		file = open(OUT_PATH,'w')
-		file.write("\tName\t%s\n"%('\t'.join(self.col_labels)))
+	def write_leaders(self, file, date, n = None):
+		"""
+			write the top <n> (LEADERBOARD_SIZE by default) skiers after the races on <date>, as date, rank, fis id, name, score lines
+		"""
+		for rank, (skier_ix, score) in enumerate(self.leaderboard.top(LEADERBOARD_SIZE if n == None else n)):
+			skier_id = self.row_labels[skier_ix]
+			file.write("%s\t%d\t%s\t%s\t%d\n"%(date, rank + 1, skier_id, self.name_lookup[skier_id], score))
+	
+	def write_elo_to_file(self, path = None, fmt = None):
+		"""
+			write the scores of frequent racers, in any of the rating_writer formats
+			to OUT_PATH in OUT_FORMAT by default, as they are set when this is called
+		"""
+		if path == None:
+			path = OUT_PATH
+		if fmt == None:
+			fmt = OUT_FORMAT
 		
-		for i in range(0,len(self.elo_scores)):
+		skiers = []
+		for i in range(0,len(self.row_labels)):
 			skier_id = self.row_labels[i]
 			
 			##only want to consider frequent racers
 			if self.race_count[skier_id] >= MIN_RACES:
-				
-				name = self.name_lookup[skier_id]
-			
-				file.write("%s\t%s"%(self.row_labels[i],name))
-				for j in range(0,len(self.elo_scores[0])):
-					file.write("\t%d"%(self.elo_scores[i][j]))
-				file.write('\n')
+				skiers.append((i, skier_id, self.name_lookup[skier_id]))
+		
+		write_ratings(path, fmt, self.col_labels, skiers, self.elo_history)
 		
-		file.close()
+	def get_checkpoint(self):
+		"""
+			the current scores, race counts and names, for resuming after the most recent date
+		"""
+		checkpoint = Checkpoint(self.most_recent_date)
+		checkpoint.race_count = self.race_count
+		checkpoint.name_lookup = self.name_lookup
+		checkpoint.last_change = self.last_change
 		
+		for i in range(0,len(self.row_labels)):
+			checkpoint.ratings[self.row_labels[i]] = self.elo_history.current[i]
+		
+		return checkpoint
 		
 ###############################
 ##start control flow
 ###############################
 
-gender = "M"
-all_data = find_all_results(gender)
-
-filer = SupportFiler(gender)
+if __name__ == "__main__":
+	gender = "M"
 
-for file in all_data:
+	if PROFILE_PATH != None:
+		INSTRUMENTS.start_profile()
 	
-	##first getting race data
-	metadata = file.split('/')
-	fname_fields = metadata[4].split("_")
-	date = fname_fields[0]
-	codex = fname_fields[1]
+	checkpoint = None
+	min_date = MIN_DATE
+	if RESUME:
+		checkpoint = read_checkpoint(CHECKPOINT_PATH)
+		min_date = max(MIN_DATE, checkpoint.last_date)
+
+	filer = SupportFiler(gender)
+
+	with INSTRUMENTS.phase("load"):
+		if USE_RACE_CACHE:
+			compile_race_cache(gender)
+			races = RaceCache(RACE_CACHE_PATH%(gender)).races(min_date)
+		elif USE_RESULTS_DB:
+			races = ResultsStore(RESULTS_DB_PATH).races(gender, min_date)
+		else:
+			all_data = find_all_results(gender, min_date)
+			races = read_race_files(all_data, min_date, LOAD_PROCESSES)
+
+		for date, codex, results in races:
+			filer.add_race(results,date,codex)
 	
-	if date > MIN_DATE:
-		##now reading in the results
-		f = open(file,"r")
-		contents = [x.split('\t') for x in f.readlines()]
-		f.close()
-		
-		results = filter_valid_results(contents)
-		
-		filer.add_race(results,date,codex)
+	run_elo(filer, checkpoint)
 	
-run_elo(filer)
\ No newline at end of file
+	if PROFILE_PATH != None:
+		INSTRUMENTS.stop_profile(PROFILE_PATH)
+	INSTRUMENTS.write_report(REPORT_PATH)
\ No newline at end of file
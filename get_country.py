@@ -2,63 +2,169 @@
 ##given the fis codes from the elo.tsv file generated by elo_run.py, obtain corresponding countries of origin
 ## very hacky regex search of webpages, no html parsing
 ##some skiers cannot be found because their id changed- you'll have to replace the NAs with your own research :)
+## lookups run across a pool of worker threads sharing keep-alive connections, and resolved skiers are kept in
+## COUNTRY_CACHE_PATH so reruns only look up new skiers
 ####################################
 
 import requests
 import re
 import sys
+import time
+import os
+
+from multiprocessing.pool import ThreadPool
+
+from http_cache import HttpCache
+
+USE_HTTP_CACHE = True ## keep responses in http_cache.CACHE_DIR, so reruns only look up new skiers
+HTTP_OFFLINE = False ## only look up skiers already in the http cache
+
+WORKERS = 16 ## concurrent lookups, each holding at most one connection
+RETRIES = 3 ## retries of a failed request, before the skier is left as NA for this run
+RETRY_BACKOFF = 1.0 ## seconds before the first retry, doubling after each
+
+ELO_PATH = "./elo.tsv"
+OUT_PATH = "./countries.txt"
+COUNTRY_CACHE_PATH = "./country_cache.tsv" ## fis code, country pairs- delete a line to look a skier up again
 
 SEARCH_URL = "http://data.fis-ski.com/global-links/search-a-athlete.html?listid=&lastname=&gender=ALL&sector=CC&firstname=&nation=&status=ALL&fiscode=%s&birthyear=&Search=Search&limit=1"
 
 athlete_regex =re.compile("http://data\.fis-ski\.com/dynamic/athlete-biography\.html\?sector=CC&amp;listid=&amp;competitorid=[0-9]*")
 country_regex = re.compile('<div class="column large-8 bold"><div class="sprite-flag flag-.*"></div><span class="labelpays">.*</span></div>')
 
+##one session for all the workers, pooling a keep-alive connection per worker
+session = requests.Session()
+session.mount("http://", requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = WORKERS))
 
-## first get the codes for the skiers we need to find
-file = open("./elo.tsv",'r')
-lines = file.readlines()
-file.close()
+if USE_HTTP_CACHE:
+	http = HttpCache(offline = HTTP_OFFLINE, http = session)
+else:
+	http = session
 
-codes = []
+def get_codes(path):
+	"""
+		the fis codes of the skiers in an elo.tsv, in row order
+	"""
+	file = open(path,'r')
+	lines = file.readlines()
+	file.close()
+	
+	codes = []
+	for line in lines[1:]:
+		fields = line.split('\t')
+		codes.append(fields[0])
+	
+	return codes
 
-for line in lines[1:]:
-	fields = line.split('\t')
-	codes.append(fields[0])
+def read_country_cache(path):
+	"""
+		the fis code, country pairs resolved by earlier runs
+	"""
+	countries = {}
+	if os.path.exists(path):
+		for line in open(path,'r'):
+			fields = line.rstrip('\n').split('\t')
+			if len(fields) == 2:
+				countries[fields[0]] = fields[1]
+	return countries
+
+def get_with_retries(url):
+	"""
+		get a url, retrying failed requests and unexpected responses with a backoff
+		returns the response, or None if it never succeeded
+	"""
+	for attempt in xrange(0,RETRIES+1):
+		if attempt > 0:
+			time.sleep(RETRY_BACKOFF*2**(attempt-1))
+		
+		try:
+			req = http.get(url)
+			if req.status_code == 200:
+				return req
+			if HTTP_OFFLINE:
+				return None ##not cached- retrying won't change that
+			sys.stderr.write("Warn: unexpected response code %d for url: '%s'\n"%(req.status_code, url))
+		except requests.exceptions.RequestException as e:
+			sys.stderr.write("Warn: request failed for url: '%s' (%s)\n"%(url, e))
+	
+	return None
+
+def find_country(code):
+	"""
+		the (code, country) of a skier- the country is NA if FIS doesn't know it, or None if the lookup failed
+	"""
+	req = get_with_retries(SEARCH_URL%(code))
+	if req == None:
+		sys.stderr.write("Error: couldn't submit search requests for code: %s\n"%(code))
+		return code, None
 	
-##get country codes
+	match = athlete_regex.search(req.text)
+	if not match:
+		sys.stderr.write("Warn: couldn't find country for code: %s\n"%(code))
+		return code, "NA"
 	
-countries = []
-for code in codes:
-	req = requests.get(SEARCH_URL%(code))
-	if req.status_code == 200:
-		match = athlete_regex.search(req.text)
-		if match:
-			athlete_url = match.group(0).replace("&amp;","&")
-			
-			req2 = requests.get(athlete_url)
-			if req2.status_code == 200:
-				match2 = country_regex.search(req2.text)
-				if match2:
-					country = match2.group(0)[-16:-13] ##livin on a prayer that all countries have 3 letter codes
-					countries.append(country)
-				else:
-					countries.append("NA")
-					sys.stderr.write("Warn: during athlete search couldn't find country at url: '%s'\n"%(athlete_url))
-				
-				
-			else:
-				sys.stderr.write("Error: couldn't submit athlete search requests for code: %s\n"%(code))
-				sys.exit(0)
-				
+	athlete_url = match.group(0).replace("&amp;","&")
+	
+	req2 = get_with_retries(athlete_url)
+	if req2 == None:
+		sys.stderr.write("Error: couldn't submit athlete search requests for code: %s\n"%(code))
+		return code, None
+	
+	match2 = country_regex.search(req2.text)
+	if not match2:
+		sys.stderr.write("Warn: during athlete search couldn't find country at url: '%s'\n"%(athlete_url))
+		return code, "NA"
+	
+	return code, match2.group(0)[-16:-13] ##livin on a prayer that all countries have 3 letter codes
+
+def resolve_countries(codes, cache_path = None):
+	"""
+		look up the countries of all the skiers not already in the cache, across WORKERS threads
+		each skier is appended to the cache as soon as it resolves, so an interrupted run keeps its progress
+		returns the fis code, country pairs- skiers whose lookups failed are left out, and retried next run
+	"""
+	if cache_path == None:
+		cache_path = COUNTRY_CACHE_PATH
+	countries = read_country_cache(cache_path)
+	new_codes = sorted(set(codes) - set(countries.keys()))
+	sys.stderr.write("%d skiers, %d already resolved, looking up %d\n"%(len(set(codes)), len(set(codes)) - len(new_codes), len(new_codes)))
+	
+	if len(new_codes) == 0:
+		return countries
+	
+	start = time.time()
+	failed = 0
+	
+	pool = ThreadPool(WORKERS)
+	cache_file = open(cache_path,'a')
+	try:
+		for code, country in pool.imap_unordered(find_country, new_codes):
+			if country == None:
+				failed += 1
+				continue
 			
-		else:
-			countries.append("NA")
-			sys.stderr.write("Warn: couldn't find country for code: %s\n"%(code))
-	else:
-		sys.stderr.write("Error: couldn't submit search requests for code: %s\n"%(code))
-		sys.exit(0)
+			countries[code] = country
+			cache_file.write("%s\t%s\n"%(code, country))
+			cache_file.flush()
+	finally:
+		cache_file.close()
+		pool.close()
+		pool.join()
+	
+	sys.stderr.write("looked up %d skiers in %.1fs, %d failed\n"%(len(new_codes), time.time() - start, failed))
+	return countries
+
+####################################
+## start control flow
+####################################
 
-##write to file
-file = open("./countries.txt",'w')
-file.write('\n'.join(countries))
-file.close()
\ No newline at end of file
+if __name__ == "__main__":
+	## first get the codes for the skiers we need to find
+	codes = get_codes(ELO_PATH)
+	
+	countries = resolve_countries(codes)
+	
+	##write to file, in the row order of elo.tsv
+	file = open(OUT_PATH,'w')
+	file.write('\n'.join([countries.get(x,"NA") for x in codes]))
+	file.close()
@@ -5,17 +5,42 @@
 
 import os
 import sys
+from array import array
+from itertools import izip
+
+from skier_table import SkierTable
+from rating_history import RatingHistory, day_numbers, exponential_decay
+from leaderboard import Leaderboard
+from checkpoint import Checkpoint, read_checkpoint, resumed_path
+from rating_writer import write_ratings
+from instrument import INSTRUMENTS
+from results_io import find_all_results, read_race_files, compile_race_cache, RaceCache, RaceColumns, RACE_CACHE_PATH
+from results_store import ResultsStore, RESULTS_DB_PATH
 
 DEFAULT_SCORE = 1000
 OUT_PATH = "./harkness.tsv"
+OUT_FORMAT = "tsv" ## one of rating_writer.FORMATS- tsv, tsv.gz, npy, npz, long or index
 MIN_DATE = "2000.00.00"
 MIN_RACES = 10
+CHECKPOINT_PATH = "./harkness_checkpoint.tsv"
+RESUME = False ## only ingest races dated after the checkpoint, starting from its scores- written to OUT_PATH tagged with the checkpoint date
+USE_RACE_CACHE = False ## load races from the compiled binary cache (refreshed for changed files) instead of the tsvs
+USE_RESULTS_DB = False ## load races from the sqlite store scraper.py writes with USE_RESULTS_DB, instead of the tsvs
+LOAD_PROCESSES = 1 ## >1 reads the race tsvs across a pool of processes
+REPORT_PATH = "./harkness_report.json" ## json report of per phase timings and counters, written at the end of a run
+PROFILE_PATH = None ## set to a path to dump cProfile stats for the run
+DECAY = None ## decay for idle skiers' scores, e.g. exponential_decay(365, DEFAULT_SCORE)- None for no decay
+LEADERBOARD_PATH = None ## set to a path to stream out the top LEADERBOARD_SIZE skiers (with MIN_RACES races so far) after each date
+LEADERBOARD_SIZE = 50
+LEADERBOARD_ONLY = False ## only write the leaderboard- no score history is kept, and no harkness.tsv output written
 
 class SupportFiler:
 	def __init__(self,g):
 		self.gender = g
 		
-		self.date_results = {} # date, [skier1,skier2,...,skier3] pairs
+		self.date_results = {} # date, [skier1,skier2,...,skier3] pairs, as arrays of skier ids
+		
+		self.skiers = SkierTable() # interned fis codes- the ids in date_results
 		
 		self.date_codex = {} # for looking up the event page- should be date,[codex1,codex2,] pairs
 		
@@ -23,23 +48,31 @@ class SupportFiler:
 	
 	def add_race(self, results, date, codex):
 		"""
-			record a race for a given date
+			record a race for a given date, from its validated results or a cached race's RaceColumns
 		"""
-
-		results.sort(key = lambda x: int(x[2]))
+		if isinstance(results, RaceColumns):
+			##the cache stores races placement ordered
+			fis_codes = results.get_fis_codes()
+			names = results.get_names()
+		else:
+			results.sort(key = lambda x: int(x[2]))
+			fis_codes = [x[0] for x in results]
+			names = [x[1] for x in results]
 		
-		ordered = [x[0] for x in results]
+		ordered = array('i', [self.skiers.intern(x) for x in fis_codes])
 		
 		if not date in self.date_results:
 			self.date_results[date] = ordered
+			INSTRUMENTS.count("races_filed")
 		else:
 			sys.stderr.write("Warn: multiple races on one day, ignoring...\n")
+			INSTRUMENTS.count("races_ignored")
 		
 		
 		##keep track of names
-		for entry in results:
-			if not entry[0] in self.name_lookup:
-				self.name_lookup[entry[0]] = entry[1]
+		for fis_code, name in izip(fis_codes, names):
+			if not fis_code in self.name_lookup:
+				self.name_lookup[fis_code] = name
 
 
 		##keep track of other metadata
@@ -68,61 +101,86 @@ class SupportFiler:
 		
 		"""
 	
-def filter_valid_results(results):
+def run_harkness(filer, checkpoint = None):
 	"""
-		check if the file at <path> has the appropriate tsv structure, a fis id in the first field
-		and a ranking in the third field
+		given a filer object, perform an elo ranking
+		when resuming from a checkpoint, the filer should only hold races dated after it
 	"""
 	
-	subset = []
+	if checkpoint != None:
+		for skier_id in checkpoint.name_lookup.keys():
+			if not skier_id in filer.name_lookup:
+				filer.name_lookup[skier_id] = checkpoint.name_lookup[skier_id]
 	
-	for entry in results:
-		##need 4 fields
-		if len(entry) == 4:
-			## need a valid fis id
-			if len(entry[0]) == 7 and entry[0].isdigit():
-				if len(entry[2]) > 0 and entry[2].isdigit():
-					subset.append(entry)
-	return subset
+	runner = HarknessRunner(filer.date_results, filer.name_lookup, filer.skiers, checkpoint)
 	
-
-def find_all_results(gender):
-	"""
-		generate a list of all files across all years
-	"""
-	gender_path = "./results/%s/"%(gender)
-	year_dirs = [gender_path + x for x in os.listdir(gender_path)]
-	
-	##code barf- just rewrite if problem :)
-	race_tsvs = [y for x in [["%s/%s"%(year_dir,z) for z in os.listdir(year_dir)] for year_dir in year_dirs] for y in x]
+	leaders = None
+	if LEADERBOARD_PATH != None:
+		leaders = open(LEADERBOARD_PATH,'w')
+		leaders.write("date\trank\tfis_id\tname\tscore\n")
 	
-	return race_tsvs
-
-def run_harkness(filer):
-	"""
-		given a filer object, perform an elo ranking
-	"""
+	with INSTRUMENTS.phase("tally"):
+		for date in sorted(filer.date_results.keys()):
+			runner.tally_race(date,filer.date_results[date])
+			
+			if leaders != None:
+				runner.write_leaders(leaders, date)
 	
-	runner = HarknessRunner(filer.date_results, filer.name_lookup)
+	if leaders != None:
+		leaders.close()
 	
-	for date in sorted(filer.date_results.keys()):
-		print "handling %s results"%(date)
-		runner.tally_race(date,filer.date_results[date])
-		
-	runner.write_hark_to_file()
+	if not LEADERBOARD_ONLY:
+		with INSTRUMENTS.phase("write"):
+			##a resumed run only has the newer dates, so it goes beside the full table rather than over it
+			runner.write_hark_to_file(resumed_path(OUT_PATH, checkpoint.last_date) if checkpoint != None else None)
+	with INSTRUMENTS.phase("checkpoint"):
+		runner.get_checkpoint().write(CHECKPOINT_PATH)
 
 class HarknessRunner():
 	
-	def __init__(self, date_results, n_lookup):
+	def __init__(self, date_results, n_lookup, skiers, checkpoint = None):
 		self.name_lookup = n_lookup
 	
 		self.col_labels = sorted(date_results.keys())
 		self.row_labels = n_lookup.keys()
 		self.most_recent_date = "0000.00.00"
 		
-		##initialize all elo scores as -1, until a skier's first race
-		self.hark_scores = [[-1 for x in xrange(0,len(self.col_labels))] for y in xrange(0,len(self.row_labels))]
+		##interned integer ids for dates and skiers, so lookups don't scan the label lists
+		self.date_index = dict((d,i) for i,d in enumerate(self.col_labels))
+		self.skier_index = dict((s,i) for i,s in enumerate(self.row_labels))
+		self.skier_rows = [self.skier_index.get(x) for x in skiers.fis_codes] ##the filer's skier ids to rows
+		
+		##sparse score history- a score is only stored on the dates a skier races
+		##only a decay counts days, so only it needs every date label to be a real date- races with no date are filed under NA
+		days = day_numbers(self.col_labels) if DECAY != None else None
+		self.hark_history = RatingHistory(len(self.row_labels), len(self.col_labels), DEFAULT_SCORE, days, DECAY,
+			keep_history = not LEADERBOARD_ONLY)
 		self.race_count = {}
+		self.last_change = {} ##fis_id,date of each skier's last rating change, for the checkpoint
+		
+		##skiers with MIN_RACES races, ordered by current score as the races are tallied
+		if LEADERBOARD_PATH != None and DECAY != None:
+			raise ValueError("the leaderboard ranks undecayed scores, so can't be kept with DECAY")
+		self.leaderboard = Leaderboard() if LEADERBOARD_PATH != None else None
+		
+		##resuming- skiers start from their checkpointed scores and race counts
+		if checkpoint != None:
+			self.most_recent_date = checkpoint.last_date
+			self.race_count.update(checkpoint.race_count)
+			self.last_change.update(checkpoint.last_change)
+			
+			##a decay runs from each skier's last change- an older checkpoint without those dates can't be resumed from
+			if DECAY != None and any([checkpoint.race_count.get(x,0) > 0 and not x in checkpoint.last_change for x in checkpoint.ratings]):
+				raise ValueError("the checkpoint has no last change dates to decay from- recompute from scratch to use DECAY")
+			
+			changed = sorted(set(checkpoint.last_change.values())) if DECAY != None else []
+			days = dict(zip(changed, day_numbers(changed)))
+			for skier_id in checkpoint.ratings.keys():
+				day = days.get(checkpoint.last_change.get(skier_id))
+				self.hark_history.seed(self.skier_index[skier_id], checkpoint.ratings[skier_id], day)
+			
+			if self.leaderboard != None:
+				self.update_leaderboard(checkpoint.ratings.keys())
 		
 	def tally_race(self, date, results):
 		if date < self.most_recent_date: ##string comp on yyyy.mm.dd
@@ -130,114 +188,139 @@ class HarknessRunner():
 		
 		self.most_recent_date = date
 		
+		INSTRUMENTS.count("races_tallied")
+		INSTRUMENTS.count("skiers_tallied", len(results))
+		
+		date_ix = self.date_index[date]
+		results = [self.skier_rows[x] for x in results]
+		
 		##compute the skier average of this race
 		score_sum = 0
-		for skier_id in results:
-			score_sum += self.get_hark(date,skier_id)
+		for skier_ix in results:
+			score_sum += self.hark_history.get(skier_ix, date_ix-1, date_ix)
 		
 		if len(results) >0:
 			avg_score = score_sum / float(len(results))
 		else:
 			avg_score = -1
 			
-		for i,skier_id in enumerate(results):
+		for i,skier_ix in enumerate(results):
 			
 			pct = 100*(len(results)-i)/float(len(results)-1)
 			update = 10*(pct-50.0)
 
-			self.add_hark(date, skier_id, avg_score + update)
+			self.hark_history.set(skier_ix, date_ix, avg_score + update)
 			
 			##keep track of the number of races participated in
+			skier_id = self.row_labels[skier_ix]
 			if not skier_id in self.race_count:
 				self.race_count[skier_id] = 0
 			self.race_count[skier_id] += 1
+			self.last_change[skier_id] = date
 		
-		
-		## now fill in elo ratings for people who didn't compete in this race
-		self.update_hark(date)
+		if self.leaderboard != None:
+			self.update_leaderboard([self.row_labels[x] for x in results])
 		
 	def add_hark(self, date, skier_id, score):
-		date_ix = self.col_labels.index(date)
-		skier_ix = self.row_labels.index(skier_id)
+		date_ix = self.date_index[date]
+		skier_ix = self.skier_index[skier_id]
 		
-		self.hark_scores[skier_ix][date_ix] = score
+		self.hark_history.set(skier_ix, date_ix, score)
 		
 	def get_hark(self, max_date, skier_id):
 		"""
 			given a skier_id, get the up to date elo score
-			will return default=1000 if the player is yet to have an elo score recorded
+			will return default=1000 (or the checkpointed score) if the player is yet to have an elo score recorded
 		"""
 		
-		date_ix = self.col_labels.index(max_date)
-		skier_ix = self.row_labels.index(skier_id)
-		if date_ix > 0:
-			return self.hark_scores[skier_ix][date_ix-1]
-		else:
-			return DEFAULT_SCORE
+		date_ix = self.date_index[max_date]
+		skier_ix = self.skier_index[skier_id]
+		return self.hark_history.get(skier_ix, date_ix-1, date_ix)
 	
-	def update_hark(self, date):
+	def update_leaderboard(self, skier_ids):
 		"""
-			fill in elo for skiers that did not race in the last date
-			todo time decay- will also need to update the default_score scoring mechanism(puts later skiers at disadvantage) i.e. if has_skied(skier), then use decay
-			keep a structure for time from the last event
+			move skiers with at least MIN_RACES races to their current scores on the leaderboard
 		"""
-		date_ix = self.col_labels.index(date)
-		if date_ix > 0:
-			for i in range(0,len(self.hark_scores)):
-				if self.hark_scores[i][date_ix] < 0:
-					self.hark_scores[i][date_ix] = self.hark_scores[i][date_ix-1]
-		else:
-			for i in range(0,len(self.hark_scores)):
-				if self.hark_scores[i][date_ix] < 0:
-					self.hark_scores[i][date_ix] = DEFAULT_SCORE
-
-	def write_hark_to_file(self):
+		for skier_id in skier_ids:
+			if self.race_count.get(skier_id,0) >= MIN_RACES:
+				skier_ix = self.skier_index[skier_id]
+				self.leaderboard.update(skier_ix, self.hark_history.current[skier_ix])
 	
-		##write the elo scores, with row/column headers		
-		file = open(OUT_PATH,'w')
-		file.write("\tName\t%s\n"%('\t'.join(self.col_labels)))
+	def write_leaders(self, file, date, n = None):
+		"""
+			write the top <n> (LEADERBOARD_SIZE by default) skiers after the races on <date>, as date, rank, fis id, name, score lines
+		"""
+		for rank, (skier_ix, score) in enumerate(self.leaderboard.top(LEADERBOARD_SIZE if n == None else n)):
+			skier_id = self.row_labels[skier_ix]
+			file.write("%s\t%d\t%s\t%s\t%d\n"%(date, rank + 1, skier_id, self.name_lookup[skier_id], score))
+	
+	def write_hark_to_file(self, path = None, fmt = None):
+		"""
+			write the scores of frequent racers, in any of the rating_writer formats
+			to OUT_PATH in OUT_FORMAT by default, as they are set when this is called
+		"""
+		if path == None:
+			path = OUT_PATH
+		if fmt == None:
+			fmt = OUT_FORMAT
 		
-		for i in range(0,len(self.hark_scores)):
+		skiers = []
+		for i in range(0,len(self.row_labels)):
 			skier_id = self.row_labels[i]
 			
-			##only want to consider frequent racers
-			if self.race_count[skier_id] >= MIN_RACES:
-				
-				name = self.name_lookup[skier_id]
-			
-				file.write("%s\t%s"%(self.row_labels[i],name))
-				for j in range(0,len(self.hark_scores[0])):
-					file.write("\t%d"%(self.hark_scores[i][j]))
-				file.write('\n')
+			##only want to consider frequent racers- skiers only in ignored races have no count
+			if self.race_count.get(skier_id,0) >= MIN_RACES:
+				skiers.append((i, skier_id, self.name_lookup[skier_id]))
 		
-		file.close()
+		write_ratings(path, fmt, self.col_labels, skiers, self.hark_history)
 		
+	def get_checkpoint(self):
+		"""
+			the current scores, race counts and names, for resuming after the most recent date
+		"""
+		checkpoint = Checkpoint(self.most_recent_date)
+		checkpoint.race_count = self.race_count
+		checkpoint.name_lookup = self.name_lookup
+		checkpoint.last_change = self.last_change
+		
+		for i in range(0,len(self.row_labels)):
+			checkpoint.ratings[self.row_labels[i]] = self.hark_history.current[i]
+		
+		return checkpoint
 		
 ###############################
 ##start control flow
 ###############################
 
-gender = "M"
-all_data = find_all_results(gender)
-
-filer = SupportFiler(gender)
+if __name__ == "__main__":
+	gender = "M"
 
-for file in all_data:
+	if PROFILE_PATH != None:
+		INSTRUMENTS.start_profile()
 	
-	##first getting race data
-	metadata = file.split('/')
-	fname_fields = metadata[4].split("_")
-	date = fname_fields[0]
-	codex = fname_fields[1]
+	checkpoint = None
+	min_date = MIN_DATE
+	if RESUME:
+		checkpoint = read_checkpoint(CHECKPOINT_PATH)
+		min_date = max(MIN_DATE, checkpoint.last_date)
+
+	filer = SupportFiler(gender)
+
+	with INSTRUMENTS.phase("load"):
+		if USE_RACE_CACHE:
+			compile_race_cache(gender)
+			races = RaceCache(RACE_CACHE_PATH%(gender)).races(min_date)
+		elif USE_RESULTS_DB:
+			races = ResultsStore(RESULTS_DB_PATH).races(gender, min_date)
+		else:
+			all_data = find_all_results(gender, min_date)
+			races = read_race_files(all_data, min_date, LOAD_PROCESSES)
+
+		for date, codex, results in races:
+			filer.add_race(results,date,codex)
 	
-	if date > MIN_DATE:
-		##now reading in the results
-		f = open(file,"r")
-		contents = [x.split('\t') for x in f.readlines()]
-		f.close()
-		
-		results = filter_valid_results(contents)
-		
-		filer.add_race(results,date,codex)
+	run_harkness(filer, checkpoint)
 	
-run_harkness(filer)
\ No newline at end of file
+	if PROFILE_PATH != None:
+		INSTRUMENTS.stop_profile(PROFILE_PATH)
+	INSTRUMENTS.write_report(REPORT_PATH)
\ No newline at end of file
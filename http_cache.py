@@ -0,0 +1,171 @@
+############################################
+## a persistent on disk cache of http responses, for scraper.py and get_country.py
+## responses are stored by the sha1 of their url, with a json sidecar of when they were fetched and their validators
+## how long a response stays fresh depends on the kind of page- finished race results never change, listings do
+#############################################
+
+import os
+import re
+import json
+import time
+import codecs
+import hashlib
+import tempfile
+
+import requests
+
+from instrument import INSTRUMENTS
+
+CACHE_DIR = "./http_cache"
+OFFLINE = False ## only serve from the cache, never touch the network
+
+HOUR = 60*60
+DAY = 24*HOUR
+PERMANENT = -1
+
+## (url pattern, ttl in seconds) rules, first match wins
+TTL_RULES = [
+	(re.compile(r"all-fis-results\.html"), 6*HOUR), ## the event listing grows as the season goes on
+	(re.compile(r"event-details\.html"), DAY), ## events gain races until they are over
+	(re.compile(r"results\.html"), PERMANENT), ## race results- callers forget() races that weren't finished yet
+	(re.compile(r"search-a-athlete\.html|athlete-biography\.html"), 30*DAY),
+]
+DEFAULT_TTL = DAY
+
+def replace_file(path, text, encoding = None):
+	"""
+		write <text> to a unique temp file beside <path>, then rename it over <path>- readers never see a partial
+		file, and two threads writing the same path never share a temp file
+	"""
+	fd, tmp_path = tempfile.mkstemp(suffix = ".tmp", prefix = os.path.basename(path) + ".", dir = os.path.dirname(path) or ".")
+	try:
+		file = os.fdopen(fd,'w')
+		file.write(text.encode(encoding) if encoding != None else text)
+		file.close()
+		os.chmod(tmp_path, 0644) ##mkstemp makes the file private
+		os.rename(tmp_path, path)
+	except:
+		os.remove(tmp_path)
+		raise
+
+class CachedResponse:
+	"""
+		the parts of a requests response the scripts use, for responses served from the cache
+	"""
+	def __init__(self, url, status_code, text):
+		self.url = url
+		self.status_code = status_code
+		self.text = text
+		self.headers = {}
+
+class HttpCache:
+	"""
+		a get() that serves fresh responses from disk, revalidates stale ones with conditional requests where the
+		server gave us an etag or last-modified, and otherwise goes to the network and stores the response
+	"""
+	def __init__(self, cache_dir = None, offline = None, http = requests):
+		self.cache_dir = cache_dir if cache_dir != None else CACHE_DIR
+		self.offline = offline if offline != None else OFFLINE
+		self.http = http ## anything with a requests style get(), e.g. a requests.Session
+
+	def get_ttl(self, url):
+		for pattern, ttl in TTL_RULES:
+			if pattern.search(url):
+				return ttl
+		return DEFAULT_TTL
+
+	def get_paths(self, url):
+		"""
+			the (body, metadata) paths for a url
+		"""
+		key = hashlib.sha1(url.encode('utf-8') if isinstance(url, unicode) else url).hexdigest()
+		base = os.path.join(self.cache_dir, key[0:2], key)
+		return base + ".html", base + ".json"
+
+	def read_entry(self, url):
+		"""
+			the (metadata, text) of a cached url, or None if it isn't cached
+		"""
+		body_path, meta_path = self.get_paths(url)
+		if not os.path.exists(meta_path):
+			return None
+
+		try:
+			file = open(meta_path,'r')
+			meta = json.load(file)
+			file.close()
+
+			file = codecs.open(body_path,'r','utf-8')
+			text = file.read()
+			file.close()
+		except (IOError, ValueError):
+			return None ##a damaged entry is just a miss
+
+		return meta, text
+
+	def write_entry(self, url, text, meta):
+		"""
+			store a response- written to temp files and renamed, so concurrent readers never see partial entries
+		"""
+		body_path, meta_path = self.get_paths(url)
+
+		try:
+			os.makedirs(os.path.dirname(body_path))
+		except OSError:
+			pass ##already exists
+
+		replace_file(body_path, text, 'utf-8')
+		replace_file(meta_path, json.dumps(meta))
+
+	def forget(self, url):
+		"""
+			drop a cached url, e.g. a race result page fetched before the race was finished
+		"""
+		for path in self.get_paths(url):
+			if os.path.exists(path):
+				os.remove(path)
+
+	def get(self, url, ttl = None):
+		"""
+			get a url through the cache, using the ttl policy for the url unless <ttl> is given
+		"""
+		if ttl == None:
+			ttl = self.get_ttl(url)
+
+		entry = self.read_entry(url)
+		if entry != None:
+			meta, text = entry
+			if self.offline or ttl == PERMANENT or time.time() - meta["fetched_at"] < ttl:
+				INSTRUMENTS.count("http_cache_hits")
+				return CachedResponse(url, 200, text)
+
+		if self.offline:
+			INSTRUMENTS.count("http_cache_offline_misses")
+			return CachedResponse(url, 504, u"")
+
+		##stale- ask the server whether it changed, if it told us how to
+		headers = {}
+		if entry != None:
+			if entry[0].get("etag") != None:
+				headers["If-None-Match"] = entry[0]["etag"]
+			if entry[0].get("last_modified") != None:
+				headers["If-Modified-Since"] = entry[0]["last_modified"]
+
+		req = self.http.get(url, headers = headers)
+
+		if req.status_code == 304 and entry != None:
+			INSTRUMENTS.count("http_cache_revalidated")
+			meta["fetched_at"] = time.time()
+			self.write_entry(url, entry[1], meta)
+			return CachedResponse(url, 200, entry[1])
+
+		INSTRUMENTS.count("http_cache_misses")
+		if req.status_code == 200:
+			self.write_entry(url, req.text, {
+				"url": url,
+				"fetched_at": time.time(),
+				"etag": req.headers.get("ETag"),
+				"last_modified": req.headers.get("Last-Modified"),
+			})
+
+		return req
@@ -0,0 +1,83 @@
+############################################
+## run instrumentation- per phase wall/cpu timers, counters and an optional cProfile hook
+## the loaders, filers, runners and writers all report into the shared INSTRUMENTS, which is written out
+## as a json report at the end of a run
+#############################################
+
+import json
+import time
+import cProfile
+from contextlib import contextmanager
+
+## (rate, counter, phase) triples derived in the report- counter per second of phase wall time
+RATES = [
+	("files_per_second", "files_read", "load"),
+	("races_per_second", "races_tallied", "tally"),
+	("pairs_per_second", "pairs_tallied", "tally"),
+	("rows_written_per_second", "rows_written", "write"),
+]
+
+class Instruments:
+	"""
+		timers and counters for a run. counting is a dict update, so it is cheap enough for the hot loops
+	"""
+	def __init__(self):
+		self.started = time.time()
+		self.timers = {} ## phase, [wall seconds, cpu seconds, calls]
+		self.counters = {}
+		self.profiler = None
+
+	@contextmanager
+	def phase(self, name):
+		"""
+			time the body of a with block under phase <name>- repeated phases accumulate
+		"""
+		wall = time.time()
+		cpu = time.clock()
+		try:
+			yield
+		finally:
+			if not name in self.timers:
+				self.timers[name] = [0.0, 0.0, 0]
+			timer = self.timers[name]
+			timer[0] += time.time() - wall
+			timer[1] += time.clock() - cpu
+			timer[2] += 1
+
+	def count(self, name, n = 1):
+		self.counters[name] = self.counters.get(name, 0) + n
+
+	def start_profile(self):
+		self.profiler = cProfile.Profile()
+		self.profiler.enable()
+
+	def stop_profile(self, path):
+		"""
+			stop profiling and dump the stats to <path>, for pstats or snakeviz
+		"""
+		if self.profiler != None:
+			self.profiler.disable()
+			self.profiler.dump_stats(path)
+			self.profiler = None
+
+	def get_report(self):
+		report = {
+			"wall_seconds": time.time() - self.started,
+			"phases": dict([(name, {"wall_seconds": x[0], "cpu_seconds": x[1], "calls": x[2]}) for name, x in self.timers.items()]),
+			"counters": dict(self.counters),
+			"rates": {},
+		}
+
+		for rate, counter, phase in RATES:
+			if counter in self.counters and phase in self.timers and self.timers[phase][0] > 0:
+				report["rates"][rate] = self.counters[counter] / self.timers[phase][0]
+
+		return report
+
+	def write_report(self, path):
+		file = open(path,'w')
+		json.dump(self.get_report(), file, indent = 1, sort_keys = True)
+		file.write('\n')
+		file.close()
+
+INSTRUMENTS = Instruments()
@@ -0,0 +1,30 @@
+############################################
+## a leaderboard of current ratings, kept sorted as ratings change
+## used by the runners to stream out per date leaderboards while they tally, and by rating_index to precompute them
+#############################################
+
+import bisect
+
+class Leaderboard:
+	"""
+		keys (e.g. skier indices) ordered by score, best first- ties go to the lower key
+		an update is a bisect and a list delete/insert, so the top can be read off at any time without sorting every skier
+	"""
+	def __init__(self, scores = None):
+		self.scores = dict(scores) if scores != None else {} ## key, score pairs for everyone on the board
+		self.ranked = sorted([(-x, key) for key, x in self.scores.items()])
+
+	def update(self, key, score):
+		"""
+			put <key> on the board at <score>, moving it if it is already there
+		"""
+		if key in self.scores:
+			del self.ranked[bisect.bisect_left(self.ranked, (-self.scores[key], key))]
+		self.scores[key] = score
+		bisect.insort(self.ranked, (-score, key))
+
+	def top(self, n):
+		"""
+			the best <n> as (key, score)
+		"""
+		return [(x[1], -x[0]) for x in self.ranked[0:n]]
@@ -0,0 +1,241 @@
+############################################
+## plackett-luce ratings, fit in one batch to every ranking the elo SupportFiler collects
+## each skier has a strength gamma, and a race result is the winner picked from the field in proportion to gamma,
+## then second place from those left, and so on. the strengths are fit with the minorization-maximization
+## updates of Hunter (2004), vectorized over all rankings at once
+## ratings are reported on the elo scale- DEFAULT_SCORE + 400*log10(gamma)
+## with WINDOW_DAYS set, the model is refit on each date to the races in the trailing window instead
+#############################################
+
+import sys
+
+from elo_run import SupportFiler
+from rating_history import RatingHistory, day_numbers
+from rating_writer import write_ratings
+from instrument import INSTRUMENTS
+from results_io import find_all_results, read_race_files, compile_race_cache, RaceCache, RACE_CACHE_PATH
+from results_store import ResultsStore, RESULTS_DB_PATH
+
+try:
+	import numpy as np
+except ImportError:
+	np = None ##the fit needs numpy- checked when a runner is made
+
+DEFAULT_SCORE = 1000
+OUT_PATH = "./plackett_luce.tsv"
+OUT_FORMAT = "tsv" ## one of rating_writer.FORMATS- tsv, tsv.gz, npy, npz, long or index
+MIN_DATE = "2000.00.00"
+MIN_RACES = 10
+PRIOR = 1.0 ## virtual wins and losses each skier has against a skier rated DEFAULT_SCORE, so every strength is finite
+TOLERANCE = 1e-4 ## stop once no skier's log strength moves more than this in an iteration
+MAX_ITERATIONS = 1000
+WINDOW_DAYS = None ## refit on each date to the races in this many trailing days- None for one fit over everything
+USE_RACE_CACHE = False ## load races from the compiled binary cache (refreshed for changed files) instead of the tsvs
+USE_RESULTS_DB = False ## load races from the sqlite store scraper.py writes with USE_RESULTS_DB, instead of the tsvs
+LOAD_PROCESSES = 1 ## >1 reads the race tsvs across a pool of processes
+REPORT_PATH = "./plackett_luce_report.json" ## json report of per phase timings and counters, written at the end of a run
+PROFILE_PATH = None ## set to a path to dump cProfile stats for the run
+
+def run_plackett_luce(filer):
+	"""
+		fit and write out ratings for the races in the filer
+	"""
+	runner = PlackettLuceRunner(filer.date_results, filer.name_lookup, filer.skiers)
+
+	with INSTRUMENTS.phase("tally"):
+		if WINDOW_DAYS == None:
+			runner.fit_all()
+		else:
+			for date in sorted(filer.date_results.keys()):
+				runner.tally_race(date,filer.date_results[date])
+
+	with INSTRUMENTS.phase("write"):
+		runner.write_pl_to_file()
+
+class PlackettLuceRunner():
+
+	def __init__(self, date_results, n_lookup, skiers):
+		if np == None:
+			raise ImportError("the plackett-luce fit needs numpy")
+
+		self.name_lookup = n_lookup
+
+		self.col_labels = sorted(date_results.keys())
+		self.row_labels = n_lookup.keys()
+		self.out_labels = self.col_labels ## the dates written out- just the last one for a single fit
+
+		self.date_index = dict((d,i) for i,d in enumerate(self.col_labels))
+		self.skier_index = dict((s,i) for i,s in enumerate(self.row_labels))
+		self.skier_rows = [self.skier_index.get(x) for x in skiers.fis_codes] ##the filer's skier ids to rows
+		self.race_count = {}
+
+		##every ranking flattened, in date order, into one array of skier indices. for each entry, the bounds of its
+		##ranking (as entry indices) and whether it was a pick- everyone but last place was picked from those left
+		members = []
+		ranking_first = []
+		ranking_dates = []
+
+		for date_ix, date in enumerate(self.col_labels):
+			for ranking in date_results[date]:
+				ranking = [self.skier_rows[x] for x in ranking if self.skier_rows[x] != None]
+				if len(ranking) < 2:
+					continue
+
+				ranking_first.append(len(members))
+				ranking_dates.append(date_ix)
+				members += ranking
+
+				for skier_id in set([self.row_labels[x] for x in ranking]):
+					self.race_count[skier_id] = self.race_count.get(skier_id,0) + 1
+
+		self.members = np.array(members, dtype = int)
+		self.ranking_first = np.array(ranking_first + [len(members)], dtype = int)
+		self.ranking_dates = np.array(ranking_dates, dtype = int)
+
+		##only a window counts days, so only it needs every date label to be a real date- races with no date are filed under NA
+		self.days = None
+		if WINDOW_DAYS != None:
+			self.days = np.array(day_numbers(self.col_labels), dtype = int)
+			self.ranking_days = self.days[self.ranking_dates]
+
+		lengths = np.diff(self.ranking_first)
+		self.entry_first = np.repeat(self.ranking_first[:-1], lengths)
+		self.entry_end = np.repeat(self.ranking_first[1:], lengths)
+		self.picked = (np.arange(len(members)) != self.entry_end - 1).astype(float)
+
+		self.gamma = np.ones(len(self.row_labels)) ##strengths, warm starting each fit from the last
+		self.pl_history = RatingHistory(len(self.row_labels), len(self.col_labels), DEFAULT_SCORE)
+
+	def fit(self, first, last):
+		"""
+			fit the strengths to rankings first up to last (in date order) by MM iterations
+			only skiers in those rankings move. returns a mask of them
+		"""
+		a, b = self.ranking_first[first], self.ranking_first[last]
+		members = self.members[a:b]
+		entry_first = self.entry_first[a:b] - a
+		entry_end = self.entry_end[a:b] - a
+		picked = self.picked[a:b]
+		n = len(self.gamma)
+
+		present = np.bincount(members, minlength = n) > 0
+		wins = np.bincount(members, weights = picked, minlength = n)
+
+		gamma = self.gamma
+		for iteration in xrange(0,MAX_ITERATIONS):
+			strength = gamma[members]
+
+			##the strength left in the field at each pick- a suffix sum of the ranking from that entry on
+			suffix = np.append(np.cumsum(strength[::-1])[::-1], 0.0)
+			remaining = suffix[:-1] - suffix[entry_end]
+
+			##each skier is charged 1/remaining for every pick they were still in the field for
+			charge = picked / remaining
+			prefix = np.append(0.0, np.cumsum(charge))
+			charged = np.bincount(members, weights = prefix[1:] - prefix[entry_first], minlength = n)
+
+			##the virtual games against a strength 1 skier add PRIOR wins and 2*PRIOR charges of 1/(gamma + 1)
+			updated = np.where(present, (wins + PRIOR) / (charged + 2*PRIOR/(gamma + 1)), gamma)
+
+			change = np.abs(np.log(updated) - np.log(gamma)).max() if n > 0 else 0.0
+			gamma = updated
+			if change < TOLERANCE:
+				break
+
+		INSTRUMENTS.count("pl_iterations", iteration + 1)
+		INSTRUMENTS.count("races_tallied", last - first)
+
+		self.gamma = gamma
+		return present
+
+	def get_ratings(self):
+		return DEFAULT_SCORE + 400*np.log10(self.gamma)
+
+	def fit_all(self):
+		"""
+			one fit over every ranking, reported as of the last date
+		"""
+		present = self.fit(0, len(self.ranking_dates))
+		ratings = self.get_ratings()
+
+		self.out_labels = self.col_labels[-1:]
+		self.pl_history = RatingHistory(len(self.row_labels), len(self.out_labels), DEFAULT_SCORE)
+		for skier_ix in np.flatnonzero(present):
+			self.pl_history.set(skier_ix, 0, ratings[skier_ix])
+
+	def tally_race(self, date, rankings):
+		"""
+			refit to the races in the WINDOW_DAYS up to and including <date> (everything so far, if unset)
+			and record the ratings of the skiers in them
+		"""
+		date_ix = self.date_index[date]
+
+		first = 0
+		if WINDOW_DAYS != None:
+			first = np.searchsorted(self.ranking_days, self.days[date_ix] - WINDOW_DAYS, 'right')
+		last = np.searchsorted(self.ranking_dates, date_ix, 'right')
+
+		if last > first:
+			present = self.fit(first, last)
+			ratings = self.get_ratings()
+
+			for skier_ix in np.flatnonzero(present):
+				self.pl_history.set(skier_ix, date_ix, ratings[skier_ix])
+
+	def get_pl(self, max_date, skier_id):
+		"""
+			the rating of a skier going into the races on <max_date>, default if they haven't been fit yet
+		"""
+		date_ix = self.date_index[max_date]
+		skier_ix = self.skier_index[skier_id]
+		return self.pl_history.get(skier_ix, date_ix-1)
+
+	def write_pl_to_file(self, path = None, fmt = None):
+		"""
+			write the ratings of frequent racers, in any of the rating_writer formats
+			to OUT_PATH in OUT_FORMAT by default, as they are set when this is called
+		"""
+		if path == None:
+			path = OUT_PATH
+		if fmt == None:
+			fmt = OUT_FORMAT
+		
+		skiers = []
+		for i in range(0,len(self.row_labels)):
+			skier_id = self.row_labels[i]
+
+			##only want to consider frequent racers
+			if self.race_count.get(skier_id,0) >= MIN_RACES:
+				skiers.append((i, skier_id, self.name_lookup[skier_id]))
+
+		write_ratings(path, fmt, self.out_labels, skiers, self.pl_history)
+
+###############################
+##start control flow
+###############################
+
+if __name__ == "__main__":
+	gender = sys.argv[1] if len(sys.argv) > 1 else "M"
+
+	if PROFILE_PATH != None:
+		INSTRUMENTS.start_profile()
+
+	filer = SupportFiler(gender)
+
+	with INSTRUMENTS.phase("load"):
+		if USE_RACE_CACHE:
+			compile_race_cache(gender)
+			races = RaceCache(RACE_CACHE_PATH%(gender)).races(MIN_DATE)
+		elif USE_RESULTS_DB:
+			races = ResultsStore(RESULTS_DB_PATH).races(gender, MIN_DATE)
+		else:
+			races = read_race_files(find_all_results(gender, MIN_DATE), MIN_DATE, LOAD_PROCESSES)
+
+		for date, codex, results in races:
+			filer.add_race(results,date,codex)
+
+	run_plackett_luce(filer)
+
+	if PROFILE_PATH != None:
+		INSTRUMENTS.stop_profile(PROFILE_PATH)
+	INSTRUMENTS.write_report(REPORT_PATH)
@@ -0,0 +1,246 @@
+############################################
+## a single pass engine for running several rating systems over the same race data
+## the results tree is loaded once, then every rating system is driven through the dates in chronological order
+## usage: python rating_engine.py [gender]
+#############################################
+
+import sys
+
+import elo_run
+import harkness_run
+import plackett_luce_run
+
+from checkpoint import read_checkpoint, resumed_path
+from instrument import INSTRUMENTS
+from results_io import find_all_results, read_race_files, compile_race_cache, RaceCache, RACE_CACHE_PATH
+from results_store import ResultsStore, RESULTS_DB_PATH
+
+USE_RACE_CACHE = False ## load races from the compiled binary cache instead of the tsvs
+USE_RESULTS_DB = False ## load races from the sqlite results store instead of the tsvs
+LOAD_PROCESSES = 1 ## >1 reads the race tsvs across a pool of processes
+REPORT_PATH = "./engine_report.json" ## json report of per phase timings and counters, written at the end of a run
+PROFILE_PATH = None ## set to a path to dump cProfile stats for the run
+
+class RatingSystem:
+	"""
+		the plugin interface for a rating system driven by a RatingEngine
+		a system records the races it needs as they are loaded, then is handed every date in chronological order
+	"""
+	name = "none"
+	min_date = "0000.00.00" ## races on or before this date are not handed to the system
+
+	def add_race(self, results, date, codex):
+		"""
+			record a race of validated results (the format of results_io.filter_valid_results)
+		"""
+		raise NotImplementedError()
+
+	def get_dates(self):
+		"""
+			the dates this system has races for
+		"""
+		raise NotImplementedError()
+
+	def start(self):
+		"""
+			called once all races are loaded, before the first tally
+		"""
+
+	def tally(self, date):
+		"""
+			rate the races on <date>- called for every date any system has races on, in order
+		"""
+		raise NotImplementedError()
+
+	def get_rating(self, date, skier_id):
+		"""
+			the rating of a skier going into the races on <date>
+		"""
+		raise NotImplementedError()
+
+	def finish(self):
+		"""
+			called after the last date, e.g. to write output
+		"""
+
+class FilerSystem(RatingSystem):
+	"""
+		a rating system around one of the scripts' SupportFiler and runner pairs
+	"""
+	def __init__(self, filer, checkpoint_path, resume):
+		self.filer = filer
+		self.checkpoint_path = checkpoint_path
+		self.checkpoint = None
+		self.runner = None
+
+		if resume:
+			self.checkpoint = read_checkpoint(checkpoint_path)
+			self.min_date = max(self.min_date, self.checkpoint.last_date)
+
+	def add_race(self, results, date, codex):
+		self.filer.add_race(results, date, codex)
+
+	def get_dates(self):
+		return self.filer.date_results.keys()
+
+	def start(self):
+		if self.checkpoint != None:
+			for skier_id in self.checkpoint.name_lookup.keys():
+				if not skier_id in self.filer.name_lookup:
+					self.filer.name_lookup[skier_id] = self.checkpoint.name_lookup[skier_id]
+
+		self.runner = self.make_runner()
+
+	def make_runner(self):
+		raise NotImplementedError()
+
+	def tally(self, date):
+		if date in self.filer.date_results:
+			self.runner.tally_race(date, self.filer.date_results[date])
+
+	def finish(self):
+		self.runner.get_checkpoint().write(self.checkpoint_path)
+
+class EloSystem(FilerSystem):
+	"""
+		elo scores, as computed by elo_run.py
+	"""
+	name = "elo"
+
+	def __init__(self, gender, out_path = None, fmt = None, checkpoint_path = None, resume = None):
+		##unset arguments come from the elo_run constants as they are now, not when this module was loaded
+		self.min_date = elo_run.MIN_DATE
+		FilerSystem.__init__(self, elo_run.SupportFiler(gender), checkpoint_path if checkpoint_path != None else elo_run.CHECKPOINT_PATH,
+			resume if resume != None else elo_run.RESUME)
+		self.out_path = out_path if out_path != None else elo_run.OUT_PATH
+		if out_path == None and self.checkpoint != None:
+			self.out_path = resumed_path(self.out_path, self.checkpoint.last_date) ##only the newer dates- don't clobber the full table
+		self.fmt = fmt if fmt != None else elo_run.OUT_FORMAT
+
+	def make_runner(self):
+		return elo_run.EloRunner(self.filer.date_results, self.filer.name_lookup, self.filer.skiers, self.checkpoint)
+
+	def get_rating(self, date, skier_id):
+		return self.runner.get_elo(date, skier_id)
+
+	def finish(self):
+		self.runner.write_elo_to_file(self.out_path, self.fmt)
+		FilerSystem.finish(self)
+
+class HarknessSystem(FilerSystem):
+	"""
+		harkness scores, as computed by harkness_run.py
+	"""
+	name = "harkness"
+
+	def __init__(self, gender, out_path = None, fmt = None, checkpoint_path = None, resume = None):
+		##unset arguments come from the harkness_run constants as they are now, not when this module was loaded
+		self.min_date = harkness_run.MIN_DATE
+		FilerSystem.__init__(self, harkness_run.SupportFiler(gender), checkpoint_path if checkpoint_path != None else harkness_run.CHECKPOINT_PATH,
+			resume if resume != None else harkness_run.RESUME)
+		self.out_path = out_path if out_path != None else harkness_run.OUT_PATH
+		if out_path == None and self.checkpoint != None:
+			self.out_path = resumed_path(self.out_path, self.checkpoint.last_date) ##only the newer dates- don't clobber the full table
+		self.fmt = fmt if fmt != None else harkness_run.OUT_FORMAT
+
+	def make_runner(self):
+		return harkness_run.HarknessRunner(self.filer.date_results, self.filer.name_lookup, self.filer.skiers, self.checkpoint)
+
+	def get_rating(self, date, skier_id):
+		return self.runner.get_hark(date, skier_id)
+
+	def finish(self):
+		self.runner.write_hark_to_file(self.out_path, self.fmt)
+		FilerSystem.finish(self)
+
+class PlackettLuceSystem(FilerSystem):
+	"""
+		plackett-luce ratings, as computed by plackett_luce_run.py with a WINDOW_DAYS refit on each date
+		(over every race so far if WINDOW_DAYS is unset, so ratings going into a date never see its results)
+		it is a batch fit, so there is no checkpoint to resume from
+	"""
+	name = "plackett_luce"
+
+	def __init__(self, gender, out_path = None, fmt = None):
+		self.min_date = plackett_luce_run.MIN_DATE
+		FilerSystem.__init__(self, elo_run.SupportFiler(gender), None, False)
+		self.out_path = out_path if out_path != None else plackett_luce_run.OUT_PATH
+		self.fmt = fmt if fmt != None else plackett_luce_run.OUT_FORMAT
+
+	def make_runner(self):
+		return plackett_luce_run.PlackettLuceRunner(self.filer.date_results, self.filer.name_lookup, self.filer.skiers)
+
+	def get_rating(self, date, skier_id):
+		return self.runner.get_pl(date, skier_id)
+
+	def finish(self):
+		self.runner.write_pl_to_file(self.out_path, self.fmt)
+
+class RatingEngine:
+	"""
+		load race data once and drive any number of rating systems through it
+	"""
+	def __init__(self, systems):
+		self.systems = systems
+
+	def load(self, gender, use_cache = None, processes = None, use_db = None):
+		"""
+			read the results for a gender, handing each race to every system that wants it
+			unset arguments come from the module constants
+		"""
+		if use_cache == None:
+			use_cache = USE_RACE_CACHE
+		if processes == None:
+			processes = LOAD_PROCESSES
+		if use_db == None:
+			use_db = USE_RESULTS_DB
+		min_date = min([x.min_date for x in self.systems])
+
+		if use_cache:
+			compile_race_cache(gender)
+			races = RaceCache(RACE_CACHE_PATH%(gender)).races(min_date)
+		elif use_db:
+			races = ResultsStore(RESULTS_DB_PATH).races(gender, min_date)
+		else:
+			races = read_race_files(find_all_results(gender, min_date), min_date, processes)
+
+		for date, codex, results in races:
+			for system in self.systems:
+				if date > system.min_date:
+					system.add_race(results, date, codex)
+
+	def run(self):
+		"""
+			tally every system through the union of their dates, in one chronological pass
+		"""
+		for system in self.systems:
+			system.start()
+
+		dates = set()
+		for system in self.systems:
+			dates.update(system.get_dates())
+
+		with INSTRUMENTS.phase("tally"):
+			for date in sorted(dates):
+				for system in self.systems:
+					with INSTRUMENTS.phase("tally_%s"%(system.name)):
+						system.tally(date)
+
+		for system in self.systems:
+			with INSTRUMENTS.phase("finish_%s"%(system.name)):
+				system.finish()
+
+if __name__ == "__main__":
+	gender = sys.argv[1] if len(sys.argv) > 1 else "M"
+
+	if PROFILE_PATH != None:
+		INSTRUMENTS.start_profile()
+
+	engine = RatingEngine([EloSystem(gender), HarknessSystem(gender)])
+	with INSTRUMENTS.phase("load"):
+		engine.load(gender)
+	engine.run()
+
+	if PROFILE_PATH != None:
+		INSTRUMENTS.stop_profile(PROFILE_PATH)
+	INSTRUMENTS.write_report(REPORT_PATH)
@@ -0,0 +1,153 @@
+############################################
+## a sparse store for skier rating histories, shared by the elo and harkness runners
+## a rating is only recorded on the dates it changes- everything in between is implied
+## ratings can decay while a skier sits idle- the decay is applied when a rating is read, from the skier's last change,
+## so idle skiers are never touched
+#############################################
+
+import bisect
+import datetime
+from array import array
+
+def day_numbers(dates):
+	"""
+		the day number of each yyyy.mm.dd date label, for counting the days between dates
+	"""
+	return [datetime.datetime.strptime(x, "%Y.%m.%d").toordinal() for x in dates]
+
+def exponential_decay(half_life, mean):
+	"""
+		a decay that pulls a rating back towards <mean>, halving the distance every <half_life> idle days
+	"""
+	def decay(score, days):
+		return mean + (score - mean)*0.5**(days/float(half_life))
+	return decay
+
+class RatingHistory:
+	"""
+		a sparse skiers x dates rating matrix. each skier keeps typed arrays of (date index, rating) change points
+		plus a current rating, so memory is proportional to race appearances rather than skiers x dates
+		with a <decay>(score, idle days) function, reads decay a skier's last rating by the days since it was set-
+		<days> are the day numbers of the dates (see day_numbers). a skier's start rating only decays if it was seeded with a day
+		without <keep_history> only the current ratings are kept, for runs that only need ratings going into each
+		date as it is tallied, in order
+	"""
+	def __init__(self, n_skiers, n_dates, default, days = None, decay = None, keep_history = True):
+		if decay != None and not keep_history:
+			raise ValueError("decay needs the rating history")
+
+		self.n_dates = n_dates
+		self.default = default
+		self.days = days
+		self.decay = decay
+		self.keep_history = keep_history
+
+		self.current = [default for x in xrange(0,n_skiers)] ##most recent rating of each skier, undecayed
+		self.initial = {} ##skier index,starting rating pairs for skiers that don't start at the default
+		self.initial_days = {} ##skier index,day number pairs for starting ratings set on a known day- they decay from it
+		self.change_dates = [array('i') for x in xrange(0,n_skiers if keep_history else 0)] ##sorted date indices a skier's rating changed on
+		self.change_scores = [array('d') for x in xrange(0,n_skiers if keep_history else 0)] ##the rating set on each of those dates
+
+	def seed(self, skier_ix, score, day = None):
+		"""
+			start a skier from <score> rather than the default, e.g. when resuming from a checkpoint
+			with a decay, <day> is the day number the score was set on, so it decays from then like any other rating
+		"""
+		self.initial[skier_ix] = score
+		if day != None:
+			self.initial_days[skier_ix] = day
+		if not self.keep_history or len(self.change_dates[skier_ix]) == 0:
+			self.current[skier_ix] = score
+
+	def set(self, skier_ix, date_ix, score):
+		"""
+			record a rating for a skier on a date, overwriting any rating already recorded on that date
+		"""
+		if not self.keep_history:
+			self.current[skier_ix] = score
+			return
+
+		dates = self.change_dates[skier_ix]
+		scores = self.change_scores[skier_ix]
+
+		if len(dates) == 0 or dates[-1] < date_ix:
+			dates.append(date_ix)
+			scores.append(score)
+		else:
+			##out of time order- keep the change points sorted
+			pos = bisect.bisect_left(dates, date_ix)
+			if dates[pos] == date_ix:
+				scores[pos] = score
+			else:
+				dates.insert(pos, date_ix)
+				scores.insert(pos, score)
+
+		self.current[skier_ix] = scores[-1]
+
+	def get(self, skier_ix, date_ix, as_of = None):
+		"""
+			the rating of a skier as of a date, i.e. the last change at or before date_ix
+			the starting rating if the skier has no rating recorded yet (date_ix = -1 is before the first date)
+			with a decay, the rating is decayed up to date index <as_of>, date_ix by default
+			without the history, this is always the current rating
+		"""
+		if not self.keep_history:
+			return self.current[skier_ix]
+
+		dates = self.change_dates[skier_ix]
+
+		if len(dates) == 0:
+			return self.start(skier_ix, date_ix if as_of == None else as_of)
+		elif dates[-1] <= date_ix:
+			pos = len(dates)
+		else:
+			pos = bisect.bisect_right(dates, date_ix)
+			if pos == 0:
+				return self.start(skier_ix, date_ix if as_of == None else as_of)
+
+		score = self.change_scores[skier_ix][pos-1]
+		if self.decay != None:
+			score = self.decay(score, self.days[date_ix if as_of == None else as_of] - self.days[dates[pos-1]])
+		return score
+
+	def start(self, skier_ix, as_of = None):
+		"""
+			the rating of a skier before any change is recorded
+			a start seeded with a day is decayed up to date index <as_of>- otherwise it never decays
+		"""
+		score = self.initial.get(skier_ix, self.default)
+		if self.decay != None and as_of != None and as_of >= 0 and skier_ix in self.initial_days:
+			score = self.decay(score, self.days[as_of] - self.initial_days[skier_ix])
+		return score
+
+	def changes(self, skier_ix):
+		"""
+			the (date index, rating) change points of a skier, in date order
+		"""
+		if not self.keep_history:
+			raise ValueError("the rating history wasn't kept")
+		return zip(self.change_dates[skier_ix], self.change_scores[skier_ix])
+
+	def row(self, skier_ix):
+		"""
+			lazily rebuild the dense, forward filled (and decayed) ratings of a skier across all dates
+		"""
+		if not self.keep_history:
+			raise ValueError("the rating history wasn't kept")
+
+		dates = self.change_dates[skier_ix]
+		scores = self.change_scores[skier_ix]
+
+		score = self.start(skier_ix)
+		next_change = 0
+		for date_ix in xrange(0,self.n_dates):
+			if next_change < len(dates) and dates[next_change] == date_ix:
+				score = scores[next_change]
+				next_change += 1
+
+			if self.decay == None:
+				yield score
+			elif next_change > 0:
+				yield self.decay(score, self.days[date_ix] - self.days[dates[next_change-1]])
+			else:
+				yield self.start(skier_ix, date_ix)
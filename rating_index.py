@@ -0,0 +1,200 @@
+############################################
+## a query index over a rating history, for point in time lookups and per date leaderboards
+## written by the runners with OUT_FORMAT = "index", and read through a memory map so opening it costs nothing-
+## a skier's rating on a date is a binary search over their change points, and the top INDEX_TOP skiers on every
+## date are precomputed when the index is written
+## usage: python rating_index.py <index> <date> [n] | python rating_index.py <index> <date> <fis id>
+#############################################
+
+import os
+import sys
+import mmap
+import struct
+import bisect
+
+from leaderboard import Leaderboard
+
+INDEX_MAGIC = "SKI1"
+HEADER_FORMAT = "=4sIIIII" ## magic, number of skiers, number of dates, number of change points, leaderboard size, names block length
+DATE_LENGTH = 10 ## yyyy.mm.dd
+INDEX_TOP = 100 ## skiers in each precomputed leaderboard- deeper leaderboards are answered by scanning every skier
+
+## the file is the header, then these sections in order. skiers are in the order written, and their change points are
+## contiguous- skier i's are change points offsets[i] up to offsets[i+1]
+## (section, struct typecode, number of items) with n = skiers, d = dates, c = change points, k = leaderboard size
+SECTIONS = [
+	("offsets", "I", lambda n,d,c,k: n + 1),
+	("starts", "d", lambda n,d,c,k: n), ## rating before any change
+	("change_dates", "i", lambda n,d,c,k: c), ## date index of each change point
+	("change_scores", "d", lambda n,d,c,k: c),
+	("top_skiers", "i", lambda n,d,c,k: d*k), ## for each date, skier indices best first, -1 padded
+	("top_scores", "d", lambda n,d,c,k: d*k),
+]
+
+def write_index(path, col_labels, skiers, history, top_k = None):
+	"""
+		write an index of the rating history of <skiers>, a list of (skier index, fis id, name)
+		the leaderboards are kept up to date as each date's changes are applied, rather than sorting every skier on every date
+	"""
+	if top_k == None:
+		top_k = INDEX_TOP
+	if history.decay != None:
+		raise ValueError("the rating index stores change points, and can't represent a decayed history")
+
+	offsets = [0]
+	starts = []
+	change_dates = []
+	change_scores = []
+	date_changes = {} ## date index, [(order, score),...] pairs
+
+	for order, (skier_ix, skier_id, name) in enumerate(skiers):
+		starts.append(float(history.start(skier_ix)))
+		for date_ix, score in history.changes(skier_ix):
+			change_dates.append(date_ix)
+			change_scores.append(float(score))
+			date_changes.setdefault(date_ix, []).append((order, score))
+		offsets.append(len(change_dates))
+
+	##every skier, keyed by the order they're written in- ties go to the skier written first
+	board = Leaderboard(enumerate(starts))
+
+	top_skiers = []
+	top_scores = []
+	for date_ix in xrange(0,len(col_labels)):
+		for order, score in date_changes.get(date_ix, []):
+			board.update(order, score)
+
+		top = board.top(top_k)
+		top_skiers += [x[0] for x in top] + [-1]*(top_k - len(top))
+		top_scores += [x[1] for x in top] + [0.0]*(top_k - len(top))
+
+	names_block = '\n'.join(["%s\t%s"%(x[1], x[2]) for x in skiers])
+
+	##write to a temp file so a reader never maps a partial index
+	tmp_path = path + ".tmp"
+	f = open(tmp_path,'wb')
+	f.write(struct.pack(HEADER_FORMAT, INDEX_MAGIC, len(skiers), len(col_labels), len(change_dates), top_k, len(names_block)))
+	f.write(''.join(col_labels))
+	for values, (section, typecode, count) in zip([offsets, starts, change_dates, change_scores, top_skiers, top_scores], SECTIONS):
+		f.write(struct.pack("=%d%s"%(len(values), typecode), *values))
+	f.write(names_block)
+	f.close()
+	os.rename(tmp_path, path)
+
+class RatingIndex:
+	"""
+		a memory mapped, read only view of a rating index. nothing is read up front beyond the header-
+		point lookups and leaderboards only touch the pages they need
+	"""
+	def __init__(self, path):
+		self.path = path
+
+		f = open(path,'rb')
+		self.mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		f.close()
+
+		magic, self.n_skiers, self.n_dates, n_changes, self.top_k, self.names_len = struct.unpack_from(HEADER_FORMAT, self.mm, 0)
+		if magic != INDEX_MAGIC:
+			raise ValueError("not a rating index: %s"%(path))
+
+		self.dates_offset = struct.calcsize(HEADER_FORMAT)
+		offset = self.dates_offset + DATE_LENGTH*self.n_dates
+
+		self.sections = {} ## section, (offset, typecode, item size)
+		for section, typecode, count in SECTIONS:
+			size = struct.calcsize("=" + typecode)
+			self.sections[section] = (offset, typecode, size)
+			offset += size*count(self.n_skiers, self.n_dates, n_changes, self.top_k)
+		self.names_offset = offset
+
+		self.dates = None ## loaded on first use
+		self.skier_ids = None
+		self.names = None
+		self.skier_lookup = None
+
+	def read(self, section, i):
+		offset, typecode, size = self.sections[section]
+		return struct.unpack_from("=" + typecode, self.mm, offset + size*i)[0]
+
+	def get_dates(self):
+		if self.dates == None:
+			block = self.mm[self.dates_offset:self.dates_offset + DATE_LENGTH*self.n_dates]
+			self.dates = [block[i:i+DATE_LENGTH] for i in xrange(0,len(block),DATE_LENGTH)]
+		return self.dates
+
+	def load_names(self):
+		if self.skier_ids == None:
+			lines = self.mm[self.names_offset:self.names_offset + self.names_len].split('\n') if self.n_skiers > 0 else []
+			fields = [x.split('\t',1) for x in lines]
+			self.skier_ids = [x[0] for x in fields]
+			self.names = [x[1] for x in fields]
+			self.skier_lookup = dict((x,i) for i,x in enumerate(self.skier_ids))
+
+	def date_index(self, date):
+		"""
+			the index of the last date in the index on or before <date> (yyyy.mm.dd), -1 if it is before them all
+		"""
+		return bisect.bisect_right(self.get_dates(), date) - 1
+
+	def get_rating(self, skier_ix, date_ix):
+		"""
+			the rating of the skier at <skier_ix> after the races on date index <date_ix>
+		"""
+		first = self.read("offsets", skier_ix)
+		last = self.read("offsets", skier_ix + 1)
+
+		##binary search for the last change at or before date_ix
+		lo, hi = first, last
+		while lo < hi:
+			mid = (lo + hi)/2
+			if self.read("change_dates", mid) <= date_ix:
+				lo = mid + 1
+			else:
+				hi = mid
+
+		if lo == first:
+			return self.read("starts", skier_ix)
+		return self.read("change_scores", lo - 1)
+
+	def rating(self, skier_id, date):
+		"""
+			the rating of a skier (by fis id) as of <date>, None if the skier isn't in the index
+		"""
+		self.load_names()
+		if not skier_id in self.skier_lookup:
+			return None
+		return self.get_rating(self.skier_lookup[skier_id], self.date_index(date))
+
+	def top(self, date, n = 50):
+		"""
+			the best <n> skiers as of <date>, as (fis id, name, rating) best first
+		"""
+		self.load_names()
+		date_ix = self.date_index(date)
+
+		if date_ix < 0 or n > self.top_k:
+			##not precomputed- rate every skier
+			ranked = sorted([(-self.get_rating(i, date_ix), i) for i in xrange(0,self.n_skiers)])[0:n]
+			return [(self.skier_ids[i], self.names[i], -score) for score, i in ranked]
+
+		leaders = []
+		for i in xrange(date_ix*self.top_k, date_ix*self.top_k + n):
+			skier_ix = self.read("top_skiers", i)
+			if skier_ix < 0:
+				break
+			leaders.append((self.skier_ids[skier_ix], self.names[skier_ix], self.read("top_scores", i)))
+		return leaders
+
+	def close(self):
+		self.mm.close()
+
+if __name__ == "__main__":
+	index = RatingIndex(sys.argv[1])
+	date = sys.argv[2]
+
+	if len(sys.argv) > 3 and len(sys.argv[3]) == 7:
+		print index.rating(sys.argv[3], date)
+	else:
+		n = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+		for place, (skier_id, name, score) in enumerate(index.top(date, n)):
+			print "%d\t%s\t%s\t%.1f"%(place + 1, skier_id, name, score)
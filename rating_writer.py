@@ -0,0 +1,101 @@
+############################################
+## writing rating histories out, shared by the elo and harkness runners
+## formats:
+##	tsv	- a skiers x dates table of scores with fis id and name row headers (the original elo.tsv layout)
+##	tsv.gz	- the same table, gzip compressed
+##	npy	- a float64 skiers x dates matrix, with <path>.rows.tsv (fis id, name) and <path>.dates.txt sidecars
+##	npz	- the matrix plus fis_ids, names and dates arrays in one compressed archive
+##	long	- FIS CODE\tname\tdate\tscore lines for the dates a skier's score changed only
+##	index	- a memory mapped rating_index.RatingIndex, for point in time lookups and leaderboards
+#############################################
+
+import gzip
+
+from instrument import INSTRUMENTS
+from rating_index import write_index
+
+try:
+	import numpy as np
+except ImportError:
+	np = None ##only needed for the npy/npz formats
+
+FORMATS = ["tsv", "tsv.gz", "npy", "npz", "long", "index"]
+BUFFER_SIZE = 1<<20
+
+def write_ratings(path, fmt, col_labels, skiers, history):
+	"""
+		write the rating history of <skiers>, a list of (skier index, fis id, name), in format <fmt>
+		col_labels are the dates of the history, in order
+	"""
+	INSTRUMENTS.count("rows_written", len(skiers))
+
+	if fmt == "tsv":
+		file = open(path,'w',BUFFER_SIZE)
+		write_table(file, col_labels, skiers, history)
+		file.close()
+
+	elif fmt == "tsv.gz":
+		file = gzip.open(path,'wb')
+		write_table(file, col_labels, skiers, history)
+		file.close()
+
+	elif fmt == "npy" or fmt == "npz":
+		scores = dense_matrix(len(col_labels), skiers, history)
+
+		if fmt == "npy":
+			np.save(path, scores)
+
+			file = open(path + ".rows.tsv",'w')
+			file.write(''.join(["%s\t%s\n"%(x[1],x[2]) for x in skiers]))
+			file.close()
+
+			file = open(path + ".dates.txt",'w')
+			file.write(''.join(["%s\n"%(x) for x in col_labels]))
+			file.close()
+		else:
+			np.savez_compressed(path, scores = scores, fis_ids = np.array([x[1] for x in skiers]),
+				names = np.array([x[2] for x in skiers]), dates = np.array(col_labels))
+
+	elif fmt == "long":
+		file = open(path,'w',BUFFER_SIZE)
+		file.write("fis_id\tname\tdate\tscore\n")
+		for skier_ix, skier_id, name in skiers:
+			file.write(''.join(["%s\t%s\t%s\t%d\n"%(skier_id, name, col_labels[date_ix], score) for date_ix, score in history.changes(skier_ix)]))
+		file.close()
+
+	elif fmt == "index":
+		write_index(path, col_labels, skiers, history)
+
+	else:
+		raise ValueError("unknown output format '%s', expected one of %s"%(fmt, ', '.join(FORMATS)))
+
+def write_table(file, col_labels, skiers, history):
+	"""
+		write the dense tsv table, formatting each row in one go
+	"""
+	file.write("\tName\t%s\n"%('\t'.join(col_labels)))
+
+	for skier_ix, skier_id, name in skiers:
+		file.write("%s\t%s\t%s\n"%(skier_id, name, '\t'.join(["%d"%(x) for x in history.row(skier_ix)])))
+
+def dense_matrix(n_dates, skiers, history):
+	"""
+		rebuild the forward filled skiers x dates matrix from each skier's change points
+	"""
+	scores = np.empty((len(skiers), n_dates))
+
+	if history.decay != None:
+		##decayed scores vary between change points, so the rows can't be repeated out of them
+		for i,skier in enumerate(skiers):
+			scores[i] = np.fromiter(history.row(skier[0]), float, n_dates)
+		return scores
+
+	for i,skier in enumerate(skiers):
+		changes = history.changes(skier[0])
+		bounds = [0] + [x[0] for x in changes] + [n_dates]
+
+		##each score holds from its change date up to the next change
+		values = [history.start(skier[0])] + [x[1] for x in changes]
+		scores[i] = np.repeat(values, np.diff(bounds))
+
+	return scores
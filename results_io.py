@@ -0,0 +1,322 @@
+############################################
+## reading race results scraped by scraper.py, shared by elo_run.py and harkness_run.py
+## results are either read from the results/<gender>/<year>/<date>_<codex>.tsv tree, or from a compact
+## binary cache of that tree compiled by running: python results_io.py M F
+## the cache hands out each race's results as typed columns (RaceColumns) rather than tsv rows
+#############################################
+
+import os
+import sys
+import mmap
+import struct
+import multiprocessing
+from array import array
+from itertools import izip
+
+from instrument import INSTRUMENTS
+
+RACE_CACHE_PATH = "./results_%s.cache" ## per gender
+CACHE_MAGIC = "SKC2"
+HEADER_FORMAT = "=4sIIIIII" ## magic, number of races, number of result rows, number of fis codes, fis codes block length, number of names, names block length
+INDEX_FORMAT = "=40sdII" ## race file name, file mtime, first result row, number of result rows
+
+def filter_valid_results(results):
+	"""
+		check if the file at <path> has the appropriate tsv structure, a fis id in the first field
+		and a ranking in the third field
+	"""
+
+	subset = []
+
+	for entry in results:
+		##need 4 fields
+		if len(entry) == 4:
+			## need a valid fis id
+			if len(entry[0]) == 7 and entry[0].isdigit():
+				if len(entry[2]) > 0 and entry[2].isdigit():
+					subset.append(entry)
+	return subset
+
+
+def find_all_results(gender, min_date = "0000.00.00"):
+	"""
+		generate a list of all files across all years, skipping years before min_date
+	"""
+	gender_path = "./results/%s/"%(gender)
+	year_dirs = [gender_path + x for x in os.listdir(gender_path) if x >= min_date[0:4]]
+
+	##code barf- just rewrite if problem :)
+	##skipping temp files a killed scrape left behind (see http_cache.replace_file)
+	race_tsvs = [y for x in [["%s/%s"%(year_dir,z) for z in os.listdir(year_dir) if not z.endswith(".tmp")] for year_dir in year_dirs] for y in x]
+
+	return race_tsvs
+
+def parse_race_path(path):
+	"""
+		get the (date, codex) of a race from its <date>_<codex>.tsv file name
+	"""
+	fname_fields = os.path.basename(path).split("_")
+	return fname_fields[0], fname_fields[1]
+
+def read_race_file(path):
+	"""
+		read and validate the results in a race tsv
+	"""
+	f = open(path,"r")
+	contents = [x.split('\t') for x in f.readlines()]
+	f.close()
+
+	return filter_valid_results(contents)
+
+def read_race_file_counted(path):
+	"""
+		read_race_file, along with the number of rows in the file before validation
+	"""
+	f = open(path,"r")
+	contents = [x.split('\t') for x in f.readlines()]
+	f.close()
+
+	return filter_valid_results(contents), len(contents)
+
+def read_race_files(race_tsvs, min_date = "0000.00.00", processes = 1):
+	"""
+		read each race tsv dated after min_date, generating (date, codex, results) in listing order
+		with processes > 1 the files are read and validated across a process pool, and handed back in the
+		same order- the filer's name lookup (and so the output row order) depends on the order races arrive in
+	"""
+	races = [(parse_race_path(path), path) for path in race_tsvs]
+	races = [x for x in races if x[0][0] > min_date]
+
+	paths = [x[1] for x in races]
+
+	if processes > 1:
+		pool = multiprocessing.Pool(processes)
+		##imap hands results back in submission order, whichever worker finishes first
+		all_results = pool.imap(read_race_file_counted, paths, chunksize = len(paths)/(4*processes) + 1)
+	else:
+		pool = None
+		all_results = (read_race_file_counted(path) for path in paths)
+
+	try:
+		for race, (results, n_rows) in izip(races, all_results):
+			##counted here rather than in read_race_file, which may be running in a worker process
+			INSTRUMENTS.count("files_read")
+			INSTRUMENTS.count("rows_read", n_rows)
+			INSTRUMENTS.count("rows_rejected", n_rows - len(results))
+
+			yield race[0][0], race[0][1], results
+	finally:
+		if pool != None:
+			pool.terminate()
+
+def pack_time(time):
+	"""
+		pack a result time like 1:02:33.4 or +25.3 into hundredths of a second, -1 if it isn't a time
+	"""
+	try:
+		total = 0.0
+		for part in time.strip().lstrip('+').split(':'):
+			total = total*60 + float(part)
+		return int(round(total*100))
+	except (ValueError, OverflowError):
+		return -1
+
+class RaceColumns:
+	"""
+		a cached race's validated results, placement ordered, as a slice of the cache's typed columns- fis codes and
+		names are only looked up in the cache's tables when a reader asks for them
+	"""
+	__slots__ = ["cache", "first", "count"]
+
+	def __init__(self, cache, first, count):
+		self.cache = cache
+		self.first = first
+		self.count = count
+
+	def __len__(self):
+		return self.count
+
+	def get_fis_codes(self):
+		fis_codes = self.cache.fis_codes
+		return [fis_codes[x] for x in self.cache.skier_ids[self.first:self.first+self.count]]
+
+	def get_names(self):
+		names = self.cache.names
+		return [names[x] for x in self.cache.name_ids[self.first:self.first+self.count]]
+
+	def get_rows(self):
+		"""
+			the results as race tsv rows, with the placement and packed time as ints
+		"""
+		last = self.first + self.count
+		return [list(x) for x in izip(self.get_fis_codes(), self.get_names(), self.cache.placements[self.first:last], self.cache.times[self.first:last])]
+
+class RaceCache:
+	"""
+		a memory mapped, read only view of a compiled race cache. the file is a header, an index of races,
+		then columns of int32 skier ids, int16 placements, int32 times and int32 name ids, then the fis code
+		and name tables the ids point into
+	"""
+	def __init__(self, path):
+		self.path = path
+
+		f = open(path,'rb')
+		self.mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		f.close()
+
+		magic = self.mm[0:len(CACHE_MAGIC)]
+		if magic != CACHE_MAGIC:
+			self.mm.close()
+			raise ValueError("not a race cache, or one from an older version: %s"%(path))
+		magic, n_races, n_rows, n_skiers, skiers_len, n_names, names_len = struct.unpack_from(HEADER_FORMAT, self.mm, 0)
+
+		offset = struct.calcsize(HEADER_FORMAT)
+		index_size = struct.calcsize(INDEX_FORMAT)
+
+		self.index = [] ## (file name, mtime, first row, row count)
+		for i in xrange(0,n_races):
+			fname, mtime, first, count = struct.unpack_from(INDEX_FORMAT, self.mm, offset)
+			self.index.append((fname.rstrip('\0'), mtime, first, count))
+			offset += index_size
+
+		self.skier_ids = self.read_column('i', offset, n_rows)
+		offset += 4*n_rows
+		self.placements = self.read_column('h', offset, n_rows)
+		offset += 2*n_rows
+		self.times = self.read_column('i', offset, n_rows)
+		offset += 4*n_rows
+		self.name_ids = self.read_column('i', offset, n_rows)
+		offset += 4*n_rows
+
+		self.fis_codes = self.mm[offset:offset+skiers_len].split('\n') if n_skiers > 0 else []
+		offset += skiers_len
+		self.names = self.mm[offset:offset+names_len].split('\n') if n_names > 0 else []
+
+	def read_column(self, typecode, offset, n):
+		column = array(typecode)
+		column.fromstring(self.mm[offset:offset + column.itemsize*n])
+		return column
+
+	def get_results(self, race_ix):
+		"""
+			the results of a race as typed columns
+		"""
+		first, count = self.index[race_ix][2:4]
+		return RaceColumns(self, first, count)
+
+	def races(self, min_date = "0000.00.00"):
+		"""
+			generate (date, codex, results) for every race dated after min_date, in the order they were compiled-
+			the results are RaceColumns rather than tsv rows
+		"""
+		for i,entry in enumerate(self.index):
+			date, codex = parse_race_path(entry[0])
+
+			if date > min_date:
+				INSTRUMENTS.count("cache_races_read")
+				yield date, codex, RaceColumns(self, entry[2], entry[3])
+
+	def close(self):
+		self.mm.close()
+
+def compile_race_cache(gender, path = None):
+	"""
+		pack the results tree for a gender into a single binary race cache
+		race files whose mtime is unchanged since the last compile have their columns copied from the old cache rather
+		than re-parsed, and if no file has changed, been added or been removed the cache isn't rewritten at all
+	"""
+	if path == None:
+		path = RACE_CACHE_PATH%(gender)
+
+	listing = [(os.path.basename(x), os.path.getmtime(x), x) for x in find_all_results(gender)]
+
+	old_cache = None
+	if os.path.exists(path):
+		try:
+			old_cache = RaceCache(path)
+		except ValueError:
+			pass ##compiled again from scratch
+
+	if old_cache != None and [x[0:2] for x in old_cache.index] == [x[0:2] for x in listing]:
+		old_cache.close()
+		sys.stderr.write("%s is up to date\n"%(path))
+		return
+
+	##the old tables are kept whole, so the ids in copied columns still point at the right entries- entries only
+	##used by changed or removed races linger until the cache is deleted and compiled from scratch
+	old_races = {} ## file name, index entry pairs
+	fis_codes = []
+	names = []
+	if old_cache != None:
+		old_races = dict((x[0], x) for x in old_cache.index)
+		fis_codes = list(old_cache.fis_codes)
+		names = list(old_cache.names)
+	code_lookup = dict((x,i) for i,x in enumerate(fis_codes)) ## fis code, skier id pairs
+	name_lookup = dict((x,i) for i,x in enumerate(names)) ## name, name id pairs
+
+	index = []
+	skier_ids = array('i')
+	placements = array('h')
+	times = array('i')
+	name_ids = array('i')
+
+	n_parsed = 0
+	for fname, mtime, race_path in listing:
+		old = old_races.get(fname)
+
+		if old != None and old[1] == mtime:
+			first, count = old[2:4]
+			skier_ids.extend(old_cache.skier_ids[first:first+count])
+			placements.extend(old_cache.placements[first:first+count])
+			times.extend(old_cache.times[first:first+count])
+			name_ids.extend(old_cache.name_ids[first:first+count])
+			index.append((fname, mtime, len(skier_ids) - count, count))
+			continue
+
+		##stored placement ordered, as the filers want them- the sort is stable, like theirs
+		results = [[x[0], x[1], int(x[2]), pack_time(x[3])] for x in read_race_file(race_path)]
+		results.sort(key = lambda x: x[2])
+		n_parsed += 1
+
+		index.append((fname, mtime, len(skier_ids), len(results)))
+
+		for entry in results:
+			if not entry[0] in code_lookup:
+				code_lookup[entry[0]] = len(fis_codes)
+				fis_codes.append(entry[0])
+			if not entry[1] in name_lookup:
+				name_lookup[entry[1]] = len(names)
+				names.append(entry[1])
+
+			skier_ids.append(code_lookup[entry[0]])
+			placements.append(entry[2])
+			times.append(entry[3])
+			name_ids.append(name_lookup[entry[1]])
+
+	if old_cache != None:
+		old_cache.close()
+
+	codes_block = '\n'.join(fis_codes)
+	names_block = '\n'.join(names)
+
+	##write to a temp file so an interrupted compile doesn't clobber a good cache
+	tmp_path = path + ".tmp"
+	f = open(tmp_path,'wb')
+	f.write(struct.pack(HEADER_FORMAT, CACHE_MAGIC, len(index), len(skier_ids), len(fis_codes), len(codes_block), len(names), len(names_block)))
+	for entry in index:
+		f.write(struct.pack(INDEX_FORMAT, *entry))
+	skier_ids.tofile(f)
+	placements.tofile(f)
+	times.tofile(f)
+	name_ids.tofile(f)
+	f.write(codes_block)
+	f.write(names_block)
+	f.close()
+	os.rename(tmp_path, path)
+
+	INSTRUMENTS.count("cache_files_parsed", n_parsed)
+	sys.stderr.write("compiled %d races (%d re-parsed) into %s\n"%(len(index), n_parsed, path))
+
+if __name__ == "__main__":
+	for gender in sys.argv[1:]:
+		compile_race_cache(gender)
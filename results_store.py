@@ -0,0 +1,166 @@
+############################################
+## a single file sqlite store of scraped races and their results, an alternative to the results/ tsv tree
+## scraper.py's worker threads queue up races, and one writer thread inserts them in batched transactions-
+## every race goes in whole or not at all. the rating scripts read races back out with races()
+#############################################
+
+import sys
+import time
+import sqlite3
+import threading
+import Queue
+from itertools import groupby
+
+from instrument import INSTRUMENTS
+
+RESULTS_DB_PATH = "./results.db"
+BATCH_SIZE = 50 ## races per write transaction, at most
+
+SCHEMA = [
+	"""CREATE TABLE IF NOT EXISTS races (
+		race_id INTEGER PRIMARY KEY,
+		gender TEXT NOT NULL,
+		date TEXT NOT NULL,
+		codex TEXT NOT NULL,
+		name TEXT,
+		url TEXT,
+		scraped_at REAL,
+		UNIQUE (gender, date, codex)
+	)""",
+	"""CREATE TABLE IF NOT EXISTS results (
+		race_id INTEGER NOT NULL REFERENCES races(race_id),
+		ordinal INTEGER NOT NULL,
+		fis_code TEXT,
+		name TEXT,
+		placement TEXT,
+		time TEXT
+	)""",
+	"CREATE INDEX IF NOT EXISTS races_date ON races (date)",
+	"CREATE INDEX IF NOT EXISTS results_race ON results (race_id, ordinal)",
+	"CREATE INDEX IF NOT EXISTS results_fis_code ON results (fis_code)",
+]
+
+def connect(path):
+	"""
+		a connection to the store at <path>, creating it if need be
+	"""
+	db = sqlite3.connect(path, timeout = 60)
+	db.text_factory = str ##the tsv tree hands back byte strings, so the store does too
+	db.execute("PRAGMA journal_mode=WAL") ##readers don't block the writer, nor it them
+	db.execute("PRAGMA synchronous=NORMAL")
+	for statement in SCHEMA:
+		db.execute(statement)
+	db.commit()
+	return db
+
+class ResultsStore:
+	"""
+		the races and results in a sqlite file. sqlite connections can't be shared across threads, so all writes
+		go through a queue to a single writer thread started by start_writer()
+	"""
+	def __init__(self, path = None):
+		self.path = path if path != None else RESULTS_DB_PATH
+		self.db = connect(self.path)
+
+		self.lock = threading.Lock()
+		self.scraped = None ## (gender, date, codex) of the races in the store with results, loaded by start_writer
+		self.queue = None
+		self.writer = None
+
+	def start_writer(self):
+		##races stored without results (by older scrapes of unfinished races) are left to be scraped again
+		self.scraped = set(self.db.execute("SELECT gender, date, codex FROM races WHERE race_id IN (SELECT race_id FROM results)").fetchall())
+		self.queue = Queue.Queue(BATCH_SIZE*4)
+		self.writer = threading.Thread(target = self.write_races)
+		self.writer.start()
+
+	def has_race(self, gender, date, codex):
+		with self.lock:
+			return (gender, date, codex) in self.scraped
+
+	def add_race(self, race, rows):
+		"""
+			queue up a race (a scraper.Race) and its result rows of [fis code, name, placement, time] strings
+			for the writer. safe to call from any thread
+		"""
+		with self.lock:
+			self.scraped.add((race.gender, race.date, race.codex))
+		self.queue.put(((race.gender, race.date, race.codex, race.name, race.url), rows))
+
+	def write_races(self):
+		"""
+			the writer thread- insert queued races in transactions of up to BATCH_SIZE, until a None comes off the queue
+		"""
+		db = connect(self.path)
+		done = False
+
+		while not done:
+			batch = [self.queue.get()]
+			while len(batch) < BATCH_SIZE:
+				try:
+					batch.append(self.queue.get_nowait())
+				except Queue.Empty:
+					break
+
+			if None in batch:
+				done = True
+				batch = [x for x in batch if x != None]
+
+			try:
+				with db:
+					for race, rows in batch:
+						self.write_race(db, race, rows)
+				INSTRUMENTS.count("db_races_written", len(batch))
+			except sqlite3.Error:
+				##the batch was rolled back- retry race by race, so one bad race only loses itself
+				for race, rows in batch:
+					try:
+						with db:
+							self.write_race(db, race, rows)
+						INSTRUMENTS.count("db_races_written")
+					except sqlite3.Error as e:
+						sys.stderr.write("failed to store race %s %s %s: %s\n"%(race[0], race[1], race[2], e))
+
+		db.close()
+
+	def write_race(self, db, race, rows):
+		"""
+			replace a race and its results, within the caller's transaction
+		"""
+		db.execute("DELETE FROM results WHERE race_id IN (SELECT race_id FROM races WHERE gender = ? AND date = ? AND codex = ?)", race[0:3])
+		race_id = db.execute("INSERT OR REPLACE INTO races (gender, date, codex, name, url, scraped_at) VALUES (?,?,?,?,?,?)",
+			race + (time.time(),)).lastrowid
+		db.executemany("INSERT INTO results (race_id, ordinal, fis_code, name, placement, time) VALUES (?,?,?,?,?,?)",
+			[[race_id, i] + list(row) for i,row in enumerate(rows)])
+
+	def races(self, gender, min_date = "0000.00.00"):
+		"""
+			generate (date, codex, results) for every race of a gender dated after min_date, by date then codex
+			results are validated as the tsv readers do
+		"""
+		from results_io import filter_valid_results
+
+		rows = self.db.execute("""SELECT races.race_id, races.date, races.codex, results.fis_code, results.name, results.placement, results.time
+			FROM races LEFT JOIN results ON results.race_id = races.race_id
+			WHERE races.gender = ? AND races.date > ?
+			ORDER BY races.date, races.codex, results.ordinal""", (gender, min_date))
+
+		for (race_id, date, codex), race_rows in groupby(rows, lambda x: x[0:3]):
+			contents = [list(x[3:7]) for x in race_rows if x[3] != None] ##a race with no results joins to a row of nulls
+			results = filter_valid_results(contents)
+
+			INSTRUMENTS.count("db_races_read")
+			INSTRUMENTS.count("rows_read", len(contents))
+			INSTRUMENTS.count("rows_rejected", len(contents) - len(results))
+
+			yield date, codex, results
+
+	def close(self):
+		"""
+			flush any queued races and close the store
+		"""
+		if self.writer != None:
+			self.queue.put(None)
+			self.writer.join()
+			self.writer = None
+		self.db.close()
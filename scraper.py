@@ -13,14 +13,43 @@ import threading
 import sys
 import math
 import datetime
+import _strptime ##strptime lazily imports this, which isn't thread safe in python 2
 import os
+import Queue
+
+from multiprocessing.pool import ThreadPool
 
 from HTMLParser import HTMLParser
 
+from http_cache import HttpCache, replace_file
+from results_store import ResultsStore, RESULTS_DB_PATH
+
 dir_make_mutex = threading.Lock()
 
 NTHREADS = 20 ## number of threads to 
 
+## the pipelined crawl- listing pages -> event pages -> race result pages, each stage with its own workers
+PIPELINED = True ## set False for the original fixed slices of events per thread
+EVENT_WORKERS = 8 ## threads fetching event pages
+RACE_WORKERS = 20 ## threads fetching and writing race results
+QUEUE_SIZE = 500 ## bound on the urls/races waiting between stages
+
+## the number of listing pages isn't known up front- rather than waiting on each page to learn the next offset,
+## probe ahead a wave of offsets for every category at once
+CONCURRENT_LISTING = True
+LISTING_WAVE = 8 ## listing pages fetched at once for each category still paging
+
+USE_HTTP_CACHE = True ## keep responses in http_cache.CACHE_DIR, so reruns only fetch pages that may have changed
+HTTP_OFFLINE = False ## only scrape what is already in the http cache
+
+## incremental scraping- remember which events/races were scraped, so a refresh only fetches what is new
+INCREMENTAL = True
+MANIFEST_PATH = "./scrape_manifest.tsv"
+
+USE_RESULTS_DB = False ## write races into the sqlite store at results_store.RESULTS_DB_PATH instead of the tsv tree
+
+FAST_PARSE = True ## only feed the parsers the stretch of the page they read, rather than the whole page
+
 QUERY_FORMAT = "http://data.fis-ski.com/global-links/all-fis-results.html?seasoncode_search=all&sector_search=%s&gender_search=all&category_search=%s&date_from=begin&search=Search&limit=%d&rec_start=%d"
 
 RES_LIM = 100 ## this is the api imposed maximum- any larger value defaults to 100
@@ -29,27 +58,118 @@ RES_LIM = 100 ## this is the api imposed maximum- any larger value defaults to 1
 GENDERS = ["M","F"]
 SECTOR = "CC" ## we want cross country results 
 CATS = ["WC","SWC","OWG","WSC"] ## we want olympic, world cup, or world cup stage results
+SCRAPE_CATS = CATS ## the categories crawled- every one, for the complete history season_run.py rates
+
+
+http_cache = HttpCache(offline = HTTP_OFFLINE) if USE_HTTP_CACHE else None
+manifest = None ## a ScrapeManifest, loaded in the control flow when INCREMENTAL
+results_db = None ## a ResultsStore, opened in the control flow when USE_RESULTS_DB
+
+def fetch(url):
+	"""
+		get a page, through the http cache if it is in use
+	"""
+	if http_cache != None:
+		return http_cache.get(url)
+	return requests.get(url)
+
+## <table> and </table> tags, skipping comments, scripts and styles the way HTMLParser does- only tags have a group(1)
+TABLE_TAG = re.compile(r"<!--.*?-->|<script\b.*?</script\s*>|<style\b.*?</style\s*>|<(/?)table(?=[\s/>])", re.I | re.S)
+
+def slice_top_table(html, n):
+	"""
+		the html of the <n>th (1 based) top level table on a page, from its <table> through its </table>
+		nesting is counted the way RaceTableParser counts it, so the parser sees exactly the tags it would act on
+	"""
+	depth = 0
+	count = 0
+	start = None
+	for m in TABLE_TAG.finditer(html):
+		if m.group(1) == None:
+			continue
+		
+		if m.group(1) == "":
+			depth += 1
+			if depth == 1:
+				count += 1
+				if count == n:
+					start = m.start()
+		else:
+			if start != None and depth == 1:
+				return html[start:m.end()]
+			depth -= 1
+	
+	return html[start:] if start != None else ""
 
+def slice_from_table(html, n):
+	"""
+		the html from the <n>th (1 based) <table> tag on a page up to the next one, at any depth
+		this is exactly the stretch ResultParser reads when n is 2
+	"""
+	start = None
+	count = 0
+	for m in TABLE_TAG.finditer(html):
+		if m.group(1) == "":
+			count += 1
+			if count == n:
+				start = m.start()
+			elif count == n + 1:
+				return html[start:m.start()]
+	
+	return html[start:] if start != None else ""
+
+def parse_races(html, event):
+	"""
+		the races listed on an event page
+	"""
+	p = RaceTableParser(event)
+	if FAST_PARSE:
+		p.feed(slice_top_table(html, 1))
+	else:
+		p.feed(html)
+	return p.get_races()
+
+def parse_results(html):
+	"""
+		the results listed on a race page
+	"""
+	p = ResultParser()
+	if FAST_PARSE:
+		p.table_count = 1 ##the slice starts at the 2nd table
+		p.feed(slice_from_table(html, 2))
+	else:
+		p.feed(html)
+	return p.get_results()
 
 def get_event_urls(cat):
 	"""
 		get the url of the top level events that will drill down into individual events
 		returns a list of urls
 	"""
+	race_urls = []
+	for races_on_page in iter_event_urls(cat):
+		race_urls += races_on_page
+		
+	return race_urls
+
+def iter_event_urls(cat):
+	"""
+		page through the top level events, generating the list of event urls on each listing page as it is parsed
+		when scraping incrementally, paging stops after the first page of events that were all scraped before-
+		the listing is newest first, so everything past it is already known
+	"""
 	rec_start =0
 	has_records = True
-	race_urls = []
 	
 	while(has_records):
 		target = QUERY_FORMAT%(SECTOR,cat,RES_LIM,rec_start)
 		
 		try:
-			req = requests.get(target)
+			req = fetch(target)
 			##parsing the result html to get result urls
 			if req.status_code == 200:
 				html = req.text
 				races_on_page = parse_race_urls(html)
-				race_urls += races_on_page
 			else:
 				sys.stderr.write("Oops, you got an unexpected response looking for events at the top level\n")
 				sys.exit(0)
@@ -61,9 +181,62 @@ def get_event_urls(cat):
 		except:
 			sys.stderr.write("ignoring...failed to submit event search at url: %s\n"%(target))
 			break
-			
 		
-	return race_urls
+		yield races_on_page
+		
+		if manifest != None and len(races_on_page) > 0 and manifest.has_events(races_on_page):
+			break
+
+def fetch_listing_page(page):
+	"""
+		the event urls on the listing page at (category, rec_start), or None if it couldn't be fetched
+	"""
+	cat, rec_start = page
+	target = QUERY_FORMAT%(SECTOR,cat,RES_LIM,rec_start)
+	
+	try:
+		req = fetch(target)
+		if req.status_code == 200:
+			return parse_race_urls(req.text)
+		sys.stderr.write("Oops, you got an unexpected response looking for events at the top level\n")
+	except Exception:
+		sys.stderr.write("ignoring...failed to submit event search at url: %s\n"%(target))
+	
+	return None
+
+def iter_listing_waves(cats):
+	"""
+		page through the top level events of every category concurrently, a wave of LISTING_WAVE offsets per
+		category at a time, generating the list of event urls on each page in (category, offset) order
+		a category stops paging after the wave holding its first empty or failed page- or, when scraping
+		incrementally, its first page of events that were all scraped before
+	"""
+	pool = ThreadPool(LISTING_WAVE*len(cats))
+	next_start = dict([(x, 0) for x in cats])
+	
+	try:
+		while len(next_start) > 0:
+			pages = []
+			for cat in cats:
+				if cat in next_start:
+					pages += [(cat, next_start[cat] + x*RES_LIM) for x in xrange(0,LISTING_WAVE)]
+					next_start[cat] += LISTING_WAVE*RES_LIM
+			
+			for (cat, rec_start), races_on_page in zip(pages, pool.map(fetch_listing_page, pages)):
+				if not cat in next_start:
+					continue ##this category ended earlier in the wave
+				
+				if races_on_page == None or len(races_on_page) == 0:
+					del next_start[cat]
+					continue
+				
+				yield races_on_page
+				
+				if manifest != None and manifest.has_events(races_on_page):
+					del next_start[cat]
+	finally:
+		pool.close()
+		pool.join()
 
 def parse_race_urls(html):
 	"""
@@ -135,25 +308,147 @@ def get_race_results(events):
 	race_list = []
 	
 	for event in events:
-		p = RaceTableParser(event)
-		try:
-			req = requests.get(event)
-			if req.status_code == 200:
-				html = req.text
-				p.feed(html)
-				
-				race_list += p.get_races()
-			else:
-				sys.stderr.write("Received an unexpected response code in getting race data\n")
-				sys.exit(0)
-		except:
-			sys.stderr.write("ignoring... failed to submit race result request to url: %s"%(event))
+		race_list += get_event_races(event)
 	
 	print "received %d events, parsed out %d races"%(len(events),len(race_list))
 	
 	for race in race_list:
-		if not "qual" in race.name and not "Qual" in race.name and not "Rel" in race.name and not "rel" in race.name:
+		if is_individual_race(race) and not race.is_scraped():
 			race.write_result_to_file() 
+
+def get_event_races(event):
+	"""
+		fetch an event page and parse out its races
+	"""
+	try:
+		req = fetch(event)
+		if req.status_code == 200:
+			races = parse_races(req.text, event)
+			
+			if manifest != None:
+				manifest.add_event(event, races)
+			
+			return races
+		else:
+			sys.stderr.write("Received an unexpected response code in getting race data\n")
+			sys.exit(0)
+	except:
+		sys.stderr.write("ignoring... failed to submit race result request to url: %s"%(event))
+	
+	return []
+
+def is_individual_race(race):
+	"""
+		skip qualifiers and relays
+	"""
+	return not "qual" in race.name and not "Qual" in race.name and not "Rel" in race.name and not "rel" in race.name
+
+class RaceQueue(Queue.Queue):
+	"""
+		the bounded queue of races waiting to be downloaded. a race can be reached both from the manifest and from its
+		event page, so each is only queued the first time, keyed by (date, codex) like the manifest
+	"""
+	def __init__(self, maxsize):
+		Queue.Queue.__init__(self, maxsize)
+		self.queued = set()
+		self.queued_lock = threading.Lock()
+	
+	def put_race(self, race):
+		key = (race.date, race.codex)
+		self.queued_lock.acquire()
+		try:
+			if key in self.queued:
+				return
+			self.queued.add(key)
+		finally:
+			self.queued_lock.release()
+		
+		self.put(race)
+
+def crawl_pipelined(cats):
+	"""
+		crawl the listing pages, event pages and race result pages as a pipeline- each stage has its own
+		worker threads and hands work downstream over a bounded queue as soon as it is parsed, so race results
+		start downloading with the first event page and one slow page only holds up the worker fetching it
+	"""
+	event_queue = Queue.Queue(QUEUE_SIZE)
+	race_queue = RaceQueue(QUEUE_SIZE)
+	
+	lister = threading.Thread(target = list_events, args = (cats, event_queue, race_queue))
+	lister.start()
+	
+	event_workers = [threading.Thread(target = fetch_events, args = (event_queue, race_queue)) for x in xrange(0,EVENT_WORKERS)]
+	race_workers = [threading.Thread(target = fetch_races, args = (race_queue,)) for x in xrange(0,RACE_WORKERS)]
+	for t in event_workers + race_workers:
+		t.start()
+	
+	##each stage is told to stop (with a None per worker) once everything upstream of it has finished
+	lister.join()
+	for t in event_workers:
+		event_queue.put(None)
+	for t in event_workers:
+		t.join()
+	
+	for t in race_workers:
+		race_queue.put(None)
+	for t in race_workers:
+		t.join()
+
+def list_events(cats, event_queue, race_queue):
+	"""
+		pipeline stage 1- queue up the unique event urls of each listing page
+		when scraping incrementally, finished events are skipped, and races from earlier runs that never got
+		written are queued straight to the race stage
+	"""
+	if manifest != None:
+		for race in manifest.get_unscraped_races():
+			if is_individual_race(race):
+				race_queue.put_race(race)
+	
+	if CONCURRENT_LISTING:
+		listing = iter_listing_waves(cats)
+	else:
+		listing = (x for cat in cats for x in iter_event_urls(cat))
+	
+	visited = set()
+	for event_urls in listing:
+		for url in event_urls:
+			if not url in visited:
+				visited.add(url)
+				if manifest == None or not manifest.has_events([url]):
+					event_queue.put(url)
+	
+	print "found %d events total"%(len(visited))
+
+def fetch_events(event_queue, race_queue):
+	"""
+		pipeline stage 2- parse event pages, queueing up their individual races
+	"""
+	while True:
+		event = event_queue.get()
+		if event == None:
+			break
+		
+		try:
+			for race in get_event_races(event):
+				if is_individual_race(race) and not race.is_scraped():
+					race_queue.put_race(race)
+		except Exception as e:
+			sys.stderr.write("ignoring... failed handling event url: %s (%s)\n"%(event, e))
+
+def fetch_races(race_queue):
+	"""
+		pipeline stage 3- download and write race results
+	"""
+	while True:
+		race = race_queue.get()
+		if race == None:
+			break
+		
+		try:
+			race.write_result_to_file()
+		except Exception as e:
+			sys.stderr.write("ignoring... failed writing race at url: %s (%s)\n"%(race.url, e))
 	
 class RaceTableParser(HTMLParser):
 	"""
@@ -260,10 +555,13 @@ class RaceTableParser(HTMLParser):
 	def get_races(self):
 		return self.races
 
-class Race:
+class Race(object):
 	"""
 		a structure for storing race data
+		slotted, since the manifest holds one for every race ever scraped
 	"""
+	__slots__ = ("url", "codex", "date", "gender", "name")
+	
 	def __init__(self):
 		self.url = "NA"
 		self.codex = "NA"
@@ -274,26 +572,32 @@ class Race:
 	def write_result_to_file(self):
 		#TODO
 		try:
-			req = requests.get(self.url)
+			req = fetch(self.url)
 			
 			if req.status_code == 200:
-				p = ResultParser()
-				p.feed(req.text)
+				results = parse_results(req.text)
+				
+				##an unfinished race has no results yet (or only some)- write nothing, so the race is still unscraped
+				##once it is over, and don't keep its page cached forever
+				if len(results) == 0 or not self.is_finished():
+					if http_cache != None:
+						http_cache.forget(self.url)
+					return
 				
-				file_path = "./results/%s/%s/"%(self.gender,self.get_year())
+				if results_db != None:
+					results_db.add_race(self, [x.to_tab_string().rstrip('\n').split('\t') for x in results])
+					return
+				
+				file_path = os.path.dirname(self.get_path())
 				
 				## ensuring that the directory exists, with consideration for async threads
 				dir_make_mutex.acquire()
 				if not os.path.exists(file_path):
 					os.makedirs(file_path)
 				dir_make_mutex.release()
-					
-				outfile = file("%s/%s_%s.tsv"%(file_path,self.date,self.codex),'w')
 				
-				for result in p.get_results():
-					outfile.write(result.to_tab_string())
-					
-				outfile.close()
+				##written to a temp file and renamed, so a failed write never leaves a partial race behind
+				replace_file(self.get_path(), "".join([x.to_tab_string() for x in results]))
 				
 			else:
 				sys.stderr.write("Error: unexpected response code for a race result request")
@@ -304,6 +608,73 @@ class Race:
 			
 	def get_year(self):
 			return self.date[0:4]
+	
+	def get_path(self):
+		return "./results/%s/%s/%s_%s.tsv"%(self.gender,self.get_year(),self.date,self.codex)
+	
+	def is_scraped(self):
+		"""
+			whether the results of this race were already written- an empty file (left by older runs that wrote
+			unfinished races) doesn't count
+		"""
+		if results_db != None:
+			return results_db.has_race(self.gender, self.date, self.codex)
+		return os.path.exists(self.get_path()) and os.path.getsize(self.get_path()) > 0
+	
+	def is_finished(self):
+		return self.date != "NA" and self.date < datetime.date.today().strftime('%Y.%m.%d')
+
+class ScrapeManifest:
+	"""
+		a persisted record of the events and races that have been scraped, appended to as the scrape goes
+		a tsv of kind (event|race), url, date, codex, gender, name- races are keyed by (date, codex)
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.events = set() ## urls of finished events whose races are all recorded
+		self.races = {} ## (date, codex), Race pairs
+		
+		if os.path.exists(path):
+			for line in open(path,'r'):
+				fields = line.rstrip('\n').split('\t')
+				if len(fields) != 6:
+					continue ##a line cut short by an interrupted run
+				
+				if fields[0] == "event":
+					self.events.add(fields[1])
+				else:
+					race = Race()
+					race.url, race.date, race.codex, race.gender, race.name = fields[1:]
+					self.races[(race.date, race.codex)] = race
+	
+	def has_events(self, urls):
+		return all([x in self.events for x in urls])
+	
+	def add_event(self, url, races):
+		"""
+			record the races of an event, and the event itself once all its races are over
+		"""
+		self.lock.acquire()
+		try:
+			file = open(self.path,'a')
+			for race in races:
+				if not (race.date, race.codex) in self.races:
+					self.races[(race.date, race.codex)] = race
+					file.write("race\t%s\t%s\t%s\t%s\t%s\n"%(race.url, race.date, race.codex, race.gender, race.name))
+			
+			if len(races) > 0 and all([x.is_finished() for x in races]) and not url in self.events:
+				self.events.add(url)
+				file.write("event\t%s\tNA\tNA\tNA\tNA\n"%(url))
+			file.close()
+		finally:
+			self.lock.release()
+	
+	def get_unscraped_races(self):
+		"""
+			races recorded by earlier runs whose results were never written, e.g. after a failed request
+		"""
+		return [x for x in self.races.values() if x.is_finished() and not x.is_scraped()]
 		
 class ResultParser(HTMLParser):
 	"""
@@ -369,7 +740,9 @@ class ResultParser(HTMLParser):
 	def get_results(self):
 		return self.results
 		
-class Result:
+class Result(object):
+	__slots__ = ("placement", "fis_code", "name", "time")
+	
 	def __init__(self):
 		self.placement = "NA"
 		self.fis_code = "NA"
@@ -385,34 +758,49 @@ class Result:
 ## start control flow
 ########################################
 
-visited_urls = set()
-
-for cat in ["WC"]:#CATS:
-	event_urls = get_event_urls(cat)
+if __name__ == "__main__":
+	if INCREMENTAL:
+		manifest = ScrapeManifest(MANIFEST_PATH)
 	
-	##getting the unique urls
-	event_set = set(event_urls)
-	new_urls = list(event_set - visited_urls)
-	visited_urls |= event_set
+	if USE_RESULTS_DB:
+		results_db = ResultsStore(RESULTS_DB_PATH)
+		results_db.start_writer()
 	
-	##grouping the urls for threads- not perfectly flat groups
-	jump = int(math.ceil(len(new_urls)/float(NTHREADS))) ##ceil to ensure all urls are assigned
+	if PIPELINED:
+		crawl_pipelined(SCRAPE_CATS)
+	else:
+		visited_urls = set()
+
+		for cat in SCRAPE_CATS:
+			event_urls = get_event_urls(cat)
+
+			##getting the unique urls
+			event_set = set(event_urls)
+			new_urls = list(event_set - visited_urls)
+			visited_urls |= event_set
+
+			##grouping the urls for threads- not perfectly flat groups
+			jump = int(math.ceil(len(new_urls)/float(NTHREADS))) ##ceil to ensure all urls are assigned
+
+			if jump > 0:
+				event_groups = [new_urls[base:base+jump] for base in xrange(0,len(new_urls),jump)]
+
+				print "found %d events total\n\n"%(sum([len(x) for x in event_groups]))
+
+				t_running = []
+				##spin up threads to handle i/o bound race result scraping
+				for events in event_groups:
+					t = threading.Thread(target= get_race_results, args=(events,))
+					t.start()
+					t_running.append(t)
+
+				##not the most efficient, but doable for this small script
+				##gather all threads before proceeding to next iteration
+				for t in t_running:
+					t.join()
 	
-	if jump > 0:
-		event_groups = [new_urls[base:base+jump] for base in xrange(0,len(new_urls),jump)]
+	if results_db != None:
+		results_db.close()
 
-		print "found %d events total\n\n"%(sum([len(x) for x in event_groups]))
-		
-		t_running = []
-		##spin up threads to handle i/o bound race result scraping
-		for events in event_groups:
-			t = threading.Thread(target= get_race_results, args=(events,))
-			t.start()
-			t_running.append(t)
-		
-		##not the most efficient, but doable for this small script
-		##gather all threads before proceeding to next iteration
-		for t in t_running:
-			t.join()
 			
 ##"http://data.fis-ski.com/dynamic/event-details.html?event_id=24298&cal_suchsector=CC"
\ No newline at end of file
@@ -0,0 +1,124 @@
+############################################
+## out of core ratings over the complete history- every season, both genders
+## races are loaded and tallied one season (july through june) at a time, and only the current ratings, race counts,
+## names and last change dates are carried from one season to the next, as a checkpoint. so memory is bounded by the
+## biggest season and the number of skiers, however many years are loaded. each finished season's rating history is spilled to its own
+## file in SEASON_DIR, and the checkpoint is written alongside it so an interrupted run can pick up after the last
+## finished season
+## usage: python season_run.py [elo|harkness] [gender ...]
+#############################################
+
+import os
+import sys
+from itertools import groupby
+
+import elo_run
+import harkness_run
+
+from rating_engine import EloSystem, HarknessSystem
+from checkpoint import read_checkpoint
+from instrument import INSTRUMENTS
+from results_io import find_all_results, read_race_files, parse_race_path
+from results_store import ResultsStore, RESULTS_DB_PATH
+
+GENDERS = ["M","F"]
+MIN_DATE = "0000.00.00" ## every season
+SEASON_DIR = "./seasons"
+CHUNK_PATH = SEASON_DIR + "/%s_%s_%d.%s" ## system, gender, season, format- a season's history, in the system's OUT_FORMAT
+CHECKPOINT_PATH = SEASON_DIR + "/%s_%s_checkpoint.tsv" ## system, gender- the ratings after the last finished season
+RESUME = False ## start after the last finished season of an earlier run, from its checkpoint
+USE_RESULTS_DB = False ## load races from the sqlite store scraper.py writes with USE_RESULTS_DB, instead of the tsvs
+LOAD_PROCESSES = 1 ## >1 reads each season's race tsvs across a pool of processes
+REPORT_PATH = "./season_report.json" ## json report of per phase timings and counters, written at the end of a run
+
+## name, (rating_engine system, script module) pairs- only the incrementally updated systems can be run a season at a time
+SYSTEMS = {
+	"elo": (EloSystem, elo_run),
+	"harkness": (HarknessSystem, harkness_run),
+}
+
+def season_of(date):
+	"""
+		the season a yyyy.mm.dd date falls in, named by the year it ends in
+	"""
+	year = int(date[0:4])
+	return year + 1 if date[5:7] >= "07" else year
+
+def season_races(gender, min_date = None, use_db = None, processes = None):
+	"""
+		generate (season, races) in season order for a gender's races dated after min_date, where races generates the
+		season's (date, codex, results). a season's results are only read once its races are
+		unset arguments come from the module constants
+	"""
+	if min_date == None:
+		min_date = MIN_DATE
+	if use_db == None:
+		use_db = USE_RESULTS_DB
+	if processes == None:
+		processes = LOAD_PROCESSES
+
+	if use_db:
+		##the store already hands races back in date order
+		races = ResultsStore(RESULTS_DB_PATH).races(gender, min_date)
+	else:
+		##listing the files is cheap- sort them into seasons up front, then read them a season at a time
+		season_paths = {}
+		for path in find_all_results(gender, min_date):
+			season_paths.setdefault(season_of(parse_race_path(path)[0]), []).append(path)
+
+		races = (race for season in sorted(season_paths.keys()) for race in read_race_files(season_paths[season], min_date, processes))
+
+	return groupby(races, lambda x: season_of(x[0]))
+
+def run_seasons(name, gender, resume = None):
+	"""
+		run the system <name> through every season of a gender's races, spilling each season's history to CHUNK_PATH
+		and the ratings after it to CHECKPOINT_PATH
+	"""
+	system_class, module = SYSTEMS[name]
+	if resume == None:
+		resume = RESUME
+
+	if not os.path.exists(SEASON_DIR):
+		os.makedirs(SEASON_DIR)
+	checkpoint_path = CHECKPOINT_PATH%(name, gender)
+
+	checkpoint = None
+	min_date = MIN_DATE
+	if resume and os.path.exists(checkpoint_path):
+		checkpoint = read_checkpoint(checkpoint_path)
+		min_date = max(MIN_DATE, checkpoint.last_date)
+
+	for season, races in season_races(gender, min_date):
+		##a fresh filer and runner for each season, started from the last one's checkpoint- nothing else carries over
+		system = system_class(gender, CHUNK_PATH%(name, gender, season, module.OUT_FORMAT), module.OUT_FORMAT, checkpoint_path, False)
+		system.checkpoint = checkpoint
+
+		with INSTRUMENTS.phase("load"):
+			for date, codex, results in races:
+				system.add_race(results, date, codex)
+
+		system.start()
+		with INSTRUMENTS.phase("tally"):
+			for date in sorted(system.get_dates()):
+				system.tally(date)
+
+		with INSTRUMENTS.phase("write"):
+			system.finish()
+		checkpoint = system.runner.get_checkpoint()
+
+		INSTRUMENTS.count("seasons")
+		sys.stderr.write("%s %s: finished the %d season\n"%(name, gender, season))
+
+###############################
+##start control flow
+###############################
+
+if __name__ == "__main__":
+	name = sys.argv[1] if len(sys.argv) > 1 else "elo"
+	genders = sys.argv[2:] if len(sys.argv) > 2 else GENDERS
+
+	for gender in genders:
+		run_seasons(name, gender)
+
+	INSTRUMENTS.write_report(REPORT_PATH)
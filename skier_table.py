@@ -0,0 +1,30 @@
+############################################
+## interned skier ids, shared by the SupportFilers and the runners
+## a fis code is stored once, and races hold dense integer ids into the table- so a filed ranking is a typed
+## array of ids rather than a list of strings
+#############################################
+
+class SkierTable:
+	"""
+		fis codes, numbered from 0 in the order they are first seen
+	"""
+	def __init__(self):
+		self.ids = {} ##fis code, id pairs
+		self.fis_codes = [] ##the fis code of each id
+
+	def intern(self, fis_code):
+		"""
+			the id of a fis code, adding it to the table if it is new
+		"""
+		skier = self.ids.get(fis_code)
+		if skier == None:
+			skier = len(self.fis_codes)
+			self.ids[fis_code] = skier
+			self.fis_codes.append(fis_code)
+		return skier
+
+	def get_fis_code(self, skier):
+		return self.fis_codes[skier]
+
+	def __len__(self):
+		return len(self.fis_codes)
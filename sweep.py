@@ -0,0 +1,186 @@
+############################################
+## a parallel hyperparameter sweep over the elo and harkness module constants
+## the race data is loaded once, before the worker processes fork, so every worker shares it copy-on-write
+## each configuration is scored by how well its pre-race ratings ordered the pairs of skiers in each race
+## usage: python sweep.py [gender]
+#############################################
+
+import sys
+import time
+import itertools
+import multiprocessing
+
+import elo_run
+import harkness_run
+
+from rating_engine import EloSystem, HarknessSystem
+from results_io import find_all_results, read_race_files, compile_race_cache, RaceCache, RaceColumns, RACE_CACHE_PATH
+from results_store import ResultsStore, RESULTS_DB_PATH
+
+## (constant, values) grids for each rating system- every combination is run
+ELO_GRID = [
+	("K", [1,2,4,8,16,32]),
+	("DEFAULT_SCORE", [1000]),
+	("MIN_DATE", ["2000.00.00"]),
+	("MIN_RACES", [10]),
+]
+HARKNESS_GRID = [
+	("DEFAULT_SCORE", [1000]),
+	("MIN_DATE", ["2000.00.00"]),
+	("MIN_RACES", [10]),
+]
+
+GENDER = "M"
+PROCESSES = multiprocessing.cpu_count()
+OUT_PATH = "./sweep.tsv"
+USE_RACE_CACHE = False ## load races from the compiled binary cache instead of the tsvs
+USE_RESULTS_DB = False ## load races from the sqlite results store instead of the tsvs
+
+## filled in before the pool forks- (date, codex, results) for every race, and date, [ranking,...] pairs
+RACES = []
+DATE_RANKINGS = {}
+
+def get_configs():
+	"""
+		every (system name, [(constant, value),...]) configuration in the grids
+	"""
+	configs = []
+	for name, grid in [("elo", ELO_GRID), ("harkness", HARKNESS_GRID)]:
+		constants = [x[0] for x in grid]
+		for values in itertools.product(*[x[1] for x in grid]):
+			configs.append((name, zip(constants, values)))
+	return configs
+
+def load_races(gender, min_date):
+	"""
+		read every race after min_date into RACES and DATE_RANKINGS, for the workers to share
+	"""
+	if USE_RACE_CACHE:
+		compile_race_cache(gender)
+		races = RaceCache(RACE_CACHE_PATH%(gender)).races(min_date)
+	elif USE_RESULTS_DB:
+		races = ResultsStore(RESULTS_DB_PATH).races(gender, min_date)
+	else:
+		races = read_race_files(find_all_results(gender, min_date), min_date)
+
+	for date, codex, results in races:
+		if isinstance(results, RaceColumns):
+			results = results.get_rows()
+		results.sort(key = lambda x: int(x[2]))
+		RACES.append((date, codex, results))
+
+		if not date in DATE_RANKINGS:
+			DATE_RANKINGS[date] = []
+		DATE_RANKINGS[date].append([x[0] for x in results])
+
+def pair_accuracy(system, date, rankings):
+	"""
+		count the (winner, loser) pairs the system's ratings going into <date> had in the right order
+		ties count as half. returns (correct, pairs)
+	"""
+	correct = 0.0
+	pairs = 0
+
+	for ranking in rankings:
+		ratings = [system.get_rating(date, x) for x in ranking]
+
+		for i in range(0,len(ratings)):
+			for j in range(i+1,len(ratings)):
+				if ratings[i] > ratings[j]:
+					correct += 1
+				elif ratings[i] == ratings[j]:
+					correct += 0.5
+		pairs += len(ranking)*(len(ranking)-1)/2
+
+	return correct, pairs
+
+def run_config(config):
+	"""
+		run a single configuration in a worker process and summarize it
+	"""
+	config_ix, (name, params) = config
+	start = time.time()
+
+	##module constants are read at call time, and each worker process has its own copy of the modules
+	if name == "elo":
+		module = elo_run
+		system = EloSystem(GENDER, resume = False)
+	else:
+		module = harkness_run
+		system = HarknessSystem(GENDER, resume = False)
+
+	for constant, value in params:
+		setattr(module, constant, value)
+	system.min_date = module.MIN_DATE
+
+	for date, codex, results in RACES:
+		if date > system.min_date:
+			system.add_race(results, date, codex)
+
+	system.start()
+
+	correct = 0.0
+	pairs = 0
+	for date in sorted(system.get_dates()):
+		c, p = pair_accuracy(system, date, DATE_RANKINGS[date])
+		correct += c
+		pairs += p
+
+		system.tally(date)
+
+	runner = system.runner
+	history = runner.elo_history if name == "elo" else runner.hark_history
+
+	rated = [i for i,x in enumerate(runner.row_labels) if runner.race_count.get(x,0) >= module.MIN_RACES]
+	top = max(rated, key = lambda x: history.current[x]) if len(rated) > 0 else None
+
+	summary = {
+		"dates": len(runner.col_labels),
+		"rated": len(rated),
+		"accuracy": correct/pairs if pairs > 0 else 0.0,
+		"top": runner.name_lookup[runner.row_labels[top]] if top != None else "NA",
+		"top_score": history.current[top] if top != None else 0,
+		"seconds": time.time() - start,
+	}
+
+	return config_ix, name, params, summary
+
+def write_summary(path, summaries):
+	"""
+		write a tsv with one line per configuration
+	"""
+	constants = ["K", "DEFAULT_SCORE", "MIN_DATE", "MIN_RACES"]
+
+	file = open(path,'w')
+	file.write("system\t%s\tdates\trated\tpair_accuracy\ttop_skier\ttop_score\tseconds\n"%('\t'.join(constants)))
+
+	for config_ix, name, params, summary in summaries:
+		params = dict(params)
+		values = [str(params.get(x,"NA")) for x in constants]
+
+		file.write("%s\t%s\t%d\t%d\t%.5f\t%s\t%d\t%.2f\n"%(name, '\t'.join(values), summary["dates"], summary["rated"],
+			summary["accuracy"], summary["top"], summary["top_score"], summary["seconds"]))
+
+	file.close()
+
+if __name__ == "__main__":
+	if len(sys.argv) > 1:
+		GENDER = sys.argv[1]
+
+	configs = get_configs()
+	min_date = min([dict(x[1])["MIN_DATE"] for x in configs])
+
+	start = time.time()
+	load_races(GENDER, min_date)
+	sys.stderr.write("loaded %d races in %.1fs, sweeping %d configurations over %d processes\n"%(len(RACES), time.time() - start, len(configs), PROCESSES))
+
+	pool = multiprocessing.Pool(PROCESSES)
+	summaries = []
+	for summary in pool.imap_unordered(run_config, enumerate(configs)):
+		sys.stderr.write("finished %s %s in %.1fs\n"%(summary[1], summary[2], summary[3]["seconds"]))
+		summaries.append(summary)
+	pool.close()
+	pool.join()
+
+	summaries.sort()
+	write_summary(OUT_PATH, summaries)
@@ -0,0 +1,71 @@
+############################################
+## the vectorized elo tally (TALLY_MODE = "numpy") should agree with the pairwise loop
+## run with pytest, or as: python test_elo_tally.py
+#############################################
+
+import random
+
+import elo_run
+from elo_run import SupportFiler, EloRunner, victory_pairs
+
+TOLERANCE = 1e-9
+
+def random_filer(n_skiers = 60, n_dates = 25, max_races = 3, seed = 0):
+	"""
+		a filer of random races- up to <max_races> on each date, so dates with several races are covered
+	"""
+	rand = random.Random(seed)
+	skiers = ["%07d"%(1000000 + x) for x in xrange(0,n_skiers)]
+	filer = SupportFiler("M")
+
+	for i in xrange(0,n_dates):
+		date = "2010.%02d.%02d"%(1 + i/28, 1 + i%28)
+		for j in xrange(0,rand.randint(1,max_races)):
+			field = rand.sample(skiers, rand.randint(2,20))
+			results = [[x, "Skier %s"%(x), str(place + 1), "0"] for place, x in enumerate(field)]
+			filer.add_race(results, date, "%d"%(1000 + i*10 + j))
+
+	return filer
+
+def check_sums(loop_sums, np_sums):
+	assert sorted(loop_sums.keys()) == sorted(np_sums.keys())
+	for skier_ix in loop_sums.keys():
+		assert abs(loop_sums[skier_ix] - np_sums[skier_ix]) < TOLERANCE, (skier_ix, loop_sums[skier_ix], np_sums[skier_ix])
+
+def test_score_sums_agree():
+	"""
+		on every date, with ratings moved away from the default by the races before it, both tallies give the same sums
+	"""
+	filer = random_filer()
+	runner = EloRunner(filer.date_results, filer.name_lookup, filer.skiers)
+
+	for date in sorted(filer.date_results.keys()):
+		date_ix = runner.date_index[date]
+		rankings = [[runner.skier_rows[x] for x in ranking] for ranking in filer.date_results[date]]
+
+		check_sums(runner.score_pairs(date_ix, victory_pairs(rankings)), runner.score_rankings_np(date_ix, rankings))
+		runner.tally_race(date, filer.date_results[date])
+
+def test_tally_modes_agree():
+	"""
+		whole runs in each mode end with the same scores
+	"""
+	filer = random_filer(seed = 1)
+
+	scores = {}
+	for mode in ["loop", "numpy"]:
+		elo_run.TALLY_MODE = mode
+		try:
+			runner = EloRunner(filer.date_results, filer.name_lookup, filer.skiers)
+			for date in sorted(filer.date_results.keys()):
+				runner.tally_race(date, filer.date_results[date])
+		finally:
+			elo_run.TALLY_MODE = "loop"
+		scores[mode] = dict(enumerate(runner.elo_history.current))
+
+	check_sums(scores["loop"], scores["numpy"])
+
+if __name__ == "__main__":
+	for test in [test_score_sums_agree, test_tally_modes_agree]:
+		test()
+		print "%s ok"%(test.__name__)
@@ -0,0 +1,73 @@
+############################################
+## the scraper files a race with no date under NA- the runners should rate a tree holding one, as they did
+## before the decay and the plackett-luce window counted days between dates, and resume from the checkpoint it leaves
+## run with pytest, or as: python test_undated_races.py
+#############################################
+
+import os
+import shutil
+import tempfile
+
+import elo_run
+import harkness_run
+import plackett_luce_run
+from checkpoint import read_checkpoint
+
+DATES = ["2010.01.02", "2010.01.09", "NA"]
+
+def filled_filer(module):
+	"""
+		a filer of one race on each of DATES
+	"""
+	filer = module.SupportFiler("M")
+	for i, date in enumerate(DATES):
+		results = [["%07d"%(1000000 + x + i), "Skier %d"%(x + i), str(x + 1), "0"] for x in xrange(0,5)]
+		filer.add_race(results, date, "%d"%(1000 + i))
+	return filer
+
+def run_undated(module, runner_class, write):
+	"""
+		tally and write out a filer with an undated race, then resume from its checkpoint
+	"""
+	out_dir = tempfile.mkdtemp()
+	try:
+		filer = filled_filer(module)
+		runner = runner_class(filer.date_results, filer.name_lookup, filer.skiers)
+		for date in sorted(filer.date_results.keys()):
+			runner.tally_race(date, filer.date_results[date])
+
+		out_path = os.path.join(out_dir, "out.tsv")
+		write(runner, out_path)
+		assert open(out_path,'r').readline().rstrip('\n').split('\t')[-1] == "NA"
+
+		checkpoint_path = os.path.join(out_dir, "checkpoint.tsv")
+		runner.get_checkpoint().write(checkpoint_path)
+		checkpoint = read_checkpoint(checkpoint_path)
+
+		filer = filled_filer(module)
+		runner = runner_class(filer.date_results, filer.name_lookup, filer.skiers, checkpoint)
+		runner.tally_race("NA", filer.date_results["NA"])
+	finally:
+		shutil.rmtree(out_dir)
+
+def test_elo_undated():
+	run_undated(elo_run, elo_run.EloRunner, lambda runner, path: runner.write_elo_to_file(path, "tsv"))
+
+def test_harkness_undated():
+	run_undated(harkness_run, harkness_run.HarknessRunner, lambda runner, path: runner.write_hark_to_file(path, "tsv"))
+
+def test_plackett_luce_undated():
+	"""
+		with no window, the fit needs no day numbers- both the single fit and the per date refits run
+	"""
+	filer = filled_filer(elo_run)
+	runner = plackett_luce_run.PlackettLuceRunner(filer.date_results, filer.name_lookup, filer.skiers)
+	for date in sorted(filer.date_results.keys()):
+		runner.tally_race(date, filer.date_results[date])
+	runner.fit_all()
+	assert runner.out_labels == ["NA"]
+
+if __name__ == "__main__":
+	for test in [test_elo_undated, test_harkness_undated, test_plackett_luce_undated]:
+		test()
+		print "%s ok"%(test.__name__)